@@ -13,6 +13,7 @@ setup(name='uopserver',
       install_requires=['uop', 'fastapi', 'uvicorn', 'pytest-asyncio',
                         'cryptography', 'aiohttp',
                         'aiohttp_session', 'aiohttp_cors', 'pyyaml', 'requests'],
+      extras_require={'zeromq': ['pyzmq'], 'brotli': ['brotli']},
       entry_points={
           'console_scripts': ['aioserve=uopserver.aio_serve.main:main']
       },
@@ -0,0 +1,21 @@
+import csv
+import io
+import os
+
+from uopserver.aio_serve.accounting import FIELDS, Accounting
+
+
+def test_reports_name_the_worker():
+    accounting = Accounting(worker='host:1')
+    accounting.usage('t').requests += 2
+    report = accounting.report()
+    assert report['worker'] == 'host:1'
+    assert report['tenants']['t']['requests'] == 2
+    rows = list(csv.DictReader(io.StringIO(accounting.csv())))
+    assert [(r['worker'], r['tenant'], r['requests']) for r in rows] == [('host:1', 't', '2')]
+    assert float(rows[0]['since']) == report['since']
+    assert set(FIELDS) < set(rows[0])
+
+
+def test_default_worker_includes_pid():
+    assert Accounting().worker.endswith(':%d' % os.getpid())
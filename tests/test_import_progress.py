@@ -0,0 +1,48 @@
+import os
+import time
+
+from uopserver.aio_serve.import_progress import ImportProgress
+
+
+def test_progress_survives_new_store(tmp_path):
+    store = ImportProgress(str(tmp_path))
+    progress = store.new('imp')
+    progress.update(lines=10, changesets=8)
+    store.save('t', progress)
+    assert ImportProgress(str(tmp_path)).load('t', 'imp')['lines'] == 10
+    assert store.load('other', 'imp') is None
+
+
+def test_lock_is_exclusive(tmp_path):
+    store = ImportProgress(str(tmp_path))
+    lock = store.lock('t', 'imp')
+    assert lock is not None
+    assert ImportProgress(str(tmp_path)).lock('t', 'imp') is None
+    store.unlock(lock)
+    again = store.lock('t', 'imp')
+    assert again is not None
+    store.unlock(again)
+
+
+def test_prune_removes_only_old_finished_imports(tmp_path):
+    store = ImportProgress(str(tmp_path), keep=60)
+    for import_id, done in (('old-done', True), ('old-running', False), ('new-done', True)):
+        progress = store.new(import_id)
+        progress['done'] = done
+        store.save('t', progress)
+    old = time.time() - 120
+    for import_id in ('old-done', 'old-running'):
+        os.utime(store.path('t', import_id) + '.json', (old, old))
+    store.prune()
+    assert store.load('t', 'old-done') is None
+    assert store.load('t', 'old-running') is not None
+    assert store.load('t', 'new-done') is not None
+
+
+def test_directory_created_by_first_import(tmp_path):
+    directory = tmp_path / 'imports'
+    store = ImportProgress(str(directory))
+    store.prune()
+    assert not directory.exists()
+    store.unlock(store.lock('t', 'imp'))
+    assert directory.is_dir()
@@ -0,0 +1,198 @@
+import asyncio
+import json
+
+import pytest
+
+from uopserver.aio_serve.journal import Journal, JournalFull
+
+
+class Recorder:
+    def __init__(self, failures=0, error=ConnectionError, bad=()):
+        self.applied = []
+        self.failures = failures
+        self.error = error
+        self.bad = bad
+
+    async def __call__(self, tenant, changes):
+        if changes['n'] in self.bad:
+            raise ValueError('bad changeset')
+        if self.failures:
+            self.failures -= 1
+            raise self.error('database unavailable')
+        self.applied.append((tenant, changes['n']))
+
+
+def make_journal(tmp_path, apply, **kwargs):
+    return Journal(str(tmp_path / 'journal'), apply, flush_interval=0, retry_delay=0.01, **kwargs)
+
+
+def test_ack_then_apply(tmp_path):
+    apply = Recorder()
+
+    async def run():
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        seqs = await asyncio.gather(*[journal.append('t', {'n': i}) for i in range(5)])
+        await journal.wait_applied(seqs[-1], timeout=5)
+        await journal.close()
+        return seqs
+
+    assert asyncio.run(run()) == [1, 2, 3, 4, 5]
+    assert apply.applied == [('t', i) for i in range(5)]
+    assert (tmp_path / 'journal.applied').read_text() == '5'
+
+
+def test_replay_after_restart(tmp_path):
+    async def write_unapplied():
+        async def never(tenant, changes):
+            await asyncio.sleep(100)
+
+        journal = make_journal(tmp_path, never)
+        await journal.start()
+        await journal.append('t', {'n': 1})
+        await journal.append('t', {'n': 2})
+        await journal.close()
+
+    apply = Recorder()
+
+    async def restart():
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        await journal.wait_applied(2, timeout=5)
+        seq = await journal.append('t', {'n': 3})
+        await journal.close()
+        return seq
+
+    asyncio.run(write_unapplied())
+    assert asyncio.run(restart()) == 3
+    assert apply.applied[:2] == [('t', 1), ('t', 2)]
+
+
+def test_torn_final_line_is_dropped(tmp_path):
+    record = json.dumps(dict(seq=1, tenant='t', changes={'n': 1}))
+    (tmp_path / 'journal').write_text(record + '\n{"seq": 2, "ten')
+    apply = Recorder()
+
+    async def run():
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        seq = await journal.append('t', {'n': 2})
+        await journal.wait_applied(seq, timeout=5)
+        await journal.close()
+        return seq
+
+    assert asyncio.run(run()) == 2
+    assert apply.applied == [('t', 1), ('t', 2)]
+
+
+def test_apply_failure_is_retried_in_order(tmp_path):
+    apply = Recorder(failures=2)
+
+    async def run():
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        await journal.append('t', {'n': 1})
+        await journal.append('t', {'n': 2})
+        await asyncio.sleep(0.005)
+        assert journal.applied == 0
+        await journal.wait_applied(2, timeout=5)
+        await journal.close()
+
+    asyncio.run(run())
+    assert apply.applied == [('t', 1), ('t', 2)]
+
+
+def test_unapplied_record_survives_restart(tmp_path):
+    async def run(apply, wait_for):
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        if wait_for is None:
+            await journal.append('t', {'n': 1})
+            await asyncio.sleep(0.05)
+        else:
+            await journal.wait_applied(wait_for, timeout=5)
+        await journal.close()
+
+    asyncio.run(run(Recorder(failures=1000), None))
+    assert b'"n": 1' in (tmp_path / 'journal').read_bytes()
+    apply = Recorder()
+    asyncio.run(run(apply, 1))
+    assert apply.applied == [('t', 1)]
+
+
+def test_failing_record_is_dead_lettered(tmp_path):
+    apply = Recorder(bad=(2,))
+
+    async def run():
+        journal = make_journal(tmp_path, apply)
+        await journal.start()
+        for i in range(1, 4):
+            seq = await journal.append('t%d' % i, {'n': i})
+        await journal.wait_applied(seq, timeout=5)
+        await journal.close()
+
+    asyncio.run(run())
+    assert apply.applied == [('t1', 1), ('t3', 3)]
+    dead = [json.loads(line) for line in (tmp_path / 'journal.dead').read_text().splitlines()]
+    assert [(d['seq'], d['changes']['n']) for d in dead] == [(2, 2)]
+    assert 'bad changeset' in dead[0]['error']
+
+
+def test_tokens_name_the_journal(tmp_path):
+    async def run(path):
+        journal = Journal(str(path), Recorder(), flush_interval=0)
+        await journal.start()
+        token = journal.token(await journal.append('t', {'n': 1}))
+        await journal.close()
+        return journal, token
+
+    journal, token = asyncio.run(run(tmp_path / 'a'))
+    other, _ = asyncio.run(run(tmp_path / 'b'))
+    assert journal.token_seq(token) == 1
+    assert other.token_seq(token) is None
+    again, _ = asyncio.run(run(tmp_path / 'a'))
+    assert again.token_seq(token) == 1
+    with pytest.raises(ValueError):
+        journal.token_seq('7')
+
+
+def test_full_journal_refuses_appends(tmp_path):
+    async def run():
+        async def never(tenant, changes):
+            await asyncio.sleep(100)
+
+        journal = make_journal(tmp_path, never, max_pending=2)
+        await journal.start()
+        await journal.append('t', {'n': 1})
+        await journal.append('t', {'n': 2})
+        with pytest.raises(JournalFull):
+            await journal.append('t', {'n': 3})
+        await journal.close()
+
+    asyncio.run(run())
+
+
+def test_compaction_keeps_unapplied_records(tmp_path):
+    async def run():
+        gate = asyncio.Event()
+        applied = []
+
+        async def apply(tenant, changes):
+            if changes['n'] == 5:
+                await gate.wait()
+            applied.append(changes['n'])
+
+        journal = make_journal(tmp_path, apply, compact_size=1)
+        await journal.start()
+        await asyncio.gather(*[journal.append('t', {'n': i}) for i in range(1, 9)])
+        await journal.wait_applied(4, timeout=5)
+        await asyncio.sleep(0.05)
+        kept = [json.loads(line)['seq'] for line in (tmp_path / 'journal').read_text().splitlines()]
+        gate.set()
+        await journal.wait_applied(8, timeout=5)
+        await journal.close()
+        return kept, applied
+
+    kept, applied = asyncio.run(run())
+    assert kept == [5, 6, 7, 8]
+    assert applied == list(range(1, 9))
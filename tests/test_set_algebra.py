@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from uopserver.aio_serve import set_algebra
+
+
+class FakeDbi:
+    def __init__(self):
+        self.tags = {'a': ['1', '2', '3'], 'b': ['2', '3', '4']}
+        self.groups = {'g': ['3']}
+        self.loads = 0
+
+    async def get_tagset(self, tag_id):
+        self.loads += 1
+        return list(self.tags[tag_id])
+
+    async def get_groupset(self, group_id):
+        self.loads += 1
+        return list(self.groups[group_id])
+
+    async def get_roleset(self, object_id, role_id):
+        self.loads += 1
+        return []
+
+
+def evaluate(cache, dbi, expr):
+    bitmap = asyncio.run(set_algebra.evaluate(cache, dbi, expr))
+    return sorted(cache.interner.ids(bitmap))
+
+
+def test_and_or_not():
+    cache, dbi = set_algebra.SetCache(), FakeDbi()
+    assert evaluate(cache, dbi, {'and': [{'tag': 'a'}, {'tag': 'b'}]}) == ['2', '3']
+    assert evaluate(cache, dbi, {'or': [{'tag': 'a'}, {'tag': 'b'}]}) == ['1', '2', '3', '4']
+    assert evaluate(cache, dbi, {'and': [{'tag': 'a'}, {'not': {'group': 'g'}}]}) == ['1', '2']
+
+
+@pytest.mark.parametrize('expr', [
+    {'not': {'tag': 'a'}},
+    {'or': [{'tag': 'a'}, {'not': {'tag': 'b'}}]},
+    {'and': [{'not': {'tag': 'a'}}]},
+    {'and': []},
+    {'color': 'red'},
+])
+def test_rejected_expressions(expr):
+    with pytest.raises(set_algebra.ExpressionError):
+        evaluate(set_algebra.SetCache(), FakeDbi(), expr)
+
+
+def test_applied_changes_update_cached_sets():
+    cache, dbi = set_algebra.SetCache(), FakeDbi()
+    evaluate(cache, dbi, {'or': [{'tag': 'a'}, {'tag': 'b'}]})
+    cache.apply_changes({'tagged': {'inserted': {'a': ['9']}, 'deleted': {'b': ['2']}}})
+    assert evaluate(cache, dbi, {'tag': 'a'}) == ['1', '2', '3', '9']
+    assert evaluate(cache, dbi, {'tag': 'b'}) == ['3', '4']
+    assert dbi.loads == 2
+
+
+def test_invalidate_reloads():
+    cache, dbi = set_algebra.SetCache(), FakeDbi()
+    evaluate(cache, dbi, {'tag': 'a'})
+    dbi.tags['a'] = ['5']
+    cache.invalidate('tag', 'a')
+    assert evaluate(cache, dbi, {'tag': 'a'}) == ['5']
+    dbi.tags['a'] = ['6']
+    cache.invalidate('tag')
+    assert evaluate(cache, dbi, {'tag': 'a'}) == ['6']
+
+
+def test_small_sets_are_stored_sparsely():
+    cache, dbi = set_algebra.SetCache(), FakeDbi()
+    dbi.tags['big'] = [str(i) for i in range(10000)]
+    dbi.tags['a'] = ['9998', '9999']
+    evaluate(cache, dbi, {'tag': 'big'})
+    evaluate(cache, dbi, {'tag': 'a'})
+    assert isinstance(cache._sets[('tag', 'big')], int)
+    assert not isinstance(cache._sets[('tag', 'a')], int)
+    cache.apply_changes({'tagged': {'inserted': {'a': ['1']}}, 'objects': {'deleted': ['9999']}})
+    assert evaluate(cache, dbi, {'tag': 'a'}) == ['1', '9998']
+    assert evaluate(cache, dbi, {'and': [{'tag': 'big'}, {'tag': 'a'}]}) == ['1', '9998']
+
+
+def test_least_recently_used_sets_are_evicted():
+    dbi = FakeDbi()
+    dbi.tags.update({str(i): [str(j) for j in range(i * 100, i * 100 + 100)] for i in range(10)})
+    cache = set_algebra.SetCache(max_bytes=600)
+    for i in range(10):
+        evaluate(cache, dbi, {'tag': str(i)})
+        evaluate(cache, dbi, {'tag': '0'})
+    assert cache.size <= 600
+    assert ('tag', '0') in cache._sets
+    assert ('tag', '1') not in cache._sets
+    assert evaluate(cache, dbi, {'tag': '1'}) == [str(j) for j in range(100, 200)]
+
+
+def test_interning_starts_over_past_max_ids():
+    cache, dbi = set_algebra.SetCache(max_ids=3), FakeDbi()
+    evaluate(cache, dbi, {'or': [{'tag': 'a'}, {'tag': 'b'}]})
+    assert len(cache.interner) == 4
+    assert evaluate(cache, dbi, {'tag': 'b'}) == ['2', '3', '4']
+    assert len(cache.interner) == 3
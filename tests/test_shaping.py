@@ -0,0 +1,47 @@
+import asyncio
+
+from uopserver.aio_serve.shaping import shape_results, shaped_call, supported_kwargs
+
+ITEMS = [dict(_id=str(i), n=i) for i in range(10)]
+
+
+def test_sort_mixed_types_and_missing_last():
+    data = [{'a': 'x'}, {'a': 3}, {}, {'a': [1]}, {'a': 2.5}, {'a': None}]
+    ascending = shape_results(data, sort='a')
+    assert [d.get('a') for d in ascending] == [2.5, 3, 'x', [1], None, None]
+    descending = shape_results(data, sort='-a')
+    assert [d.get('a') for d in descending] == [[1], 'x', 3, 2.5, None, None]
+
+
+def test_offset_limit_and_fields():
+    res = shape_results(ITEMS, fields=['n'], sort='-n', limit=2, offset=1)
+    assert res == [dict(_id='8', n=8), dict(_id='7', n=7)]
+
+
+def test_catch_all_kwargs_are_not_trusted():
+    calls = []
+
+    async def backend(ids, **kwargs):
+        calls.append(kwargs)
+        return list(ids)
+
+    assert supported_kwargs(backend, offset=5, limit=2) == {}
+    res = asyncio.run(shaped_call(backend, ITEMS, offset=5, limit=2))
+    assert [d['n'] for d in res] == [5, 6]
+    assert calls == [{}]
+
+
+def test_named_options_are_passed_down():
+    async def backend(ids, limit=None, offset=None):
+        return list(ids)[offset or 0:][:limit]
+
+    res = asyncio.run(shaped_call(backend, ITEMS, offset=5, limit=2))
+    assert [d['n'] for d in res] == [5, 6]
+
+
+def test_window_is_cut_after_server_side_sort():
+    async def backend(ids, limit=None):
+        return list(ids)[:limit]
+
+    res = asyncio.run(shaped_call(backend, ITEMS, sort='-n', limit=2))
+    assert [d['n'] for d in res] == [9, 8]
@@ -0,0 +1,76 @@
+import asyncio
+import gzip
+import json
+
+from uopserver.aio_serve.snapshots import Snapshots
+
+
+class Collection:
+    def __init__(self, items):
+        self.items = items
+
+    async def find(self):
+        return list(self.items)
+
+
+class Metadata:
+    _by_id = {'c1': {'name': 'Note'}}
+
+
+class FakeDbi:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.objects = Collection([{'_id': 'o%d' % i} for i in range(120)])
+        self.tags = Collection([{'_id': 't1'}, {'_id': 't2'}])
+        self.groups = Collection([{'_id': 'g1'}])
+
+    async def metadata(self):
+        if self.fail:
+            raise RuntimeError('database unavailable')
+        return Metadata()
+
+    async def get_tagset(self, tag_id):
+        return {'o1'} if tag_id == 't1' else set()
+
+    async def get_groupset(self, group_id):
+        return ['o2', 'o3']
+
+    async def get_object_relationships(self, object_id):
+        return {'parent': ['o0']} if object_id == 'o5' else {}
+
+
+def run_snapshots(tmp_path, dbi):
+    async def tenant_dbi(tenant):
+        return dbi
+
+    async def run():
+        snapshots = Snapshots(str(tmp_path / 'snapshots'), tenant_dbi)
+        first = snapshots.get('t')
+        building = snapshots.building('t')
+        while snapshots.building('t'):
+            await asyncio.sleep(0.01)
+        current = snapshots.get('t')
+        await snapshots.close()
+        return first, building, current, snapshots
+
+    return asyncio.run(run())
+
+
+def test_first_build_runs_in_background(tmp_path):
+    first, building, current, _ = run_snapshots(tmp_path, FakeDbi())
+    assert first is None and building
+    with gzip.open(current['path']) as f:
+        data = json.load(f)
+    assert data['cursor'] == current['cursor']
+    assert data['metadata'] == Metadata._by_id
+    assert [o['_id'] for o in data['objects']] == ['o%d' % i for i in range(120)]
+    assert data['tagged'] == {'t1': ['o1'], 't2': []}
+    assert data['grouped'] == {'g1': ['o2', 'o3']}
+    assert data['related'] == {'o5': {'parent': ['o0']}}
+
+
+def test_failed_build_is_not_restarted_at_once(tmp_path):
+    _, _, current, snapshots = run_snapshots(tmp_path, FakeDbi(fail=True))
+    assert current is None
+    assert not snapshots.building('t')
+    assert list((tmp_path / 'snapshots').glob('*.tmp')) == []
@@ -0,0 +1,125 @@
+'''
+Per tenant accounting of request and backend cost.
+
+Counters are plain attributes on one object per tenant, updated in
+place from the request middleware, the timed dbi wrapper and applied
+changesets, so recording costs a few additions per request.
+
+Counters are kept per worker process.  Reports name the worker and the
+time counting started so reports collected from several workers can be
+told apart and added up.
+'''
+import csv
+import inspect
+import io
+import os
+import socket
+import time
+from functools import wraps
+
+FIELDS = ('requests', 'errors', 'cpu', 'wall', 'db_time', 'db_calls',
+          'bytes_in', 'bytes_out', 'changesets', 'changes')
+
+
+class TenantUsage:
+    __slots__ = FIELDS
+
+    def __init__(self):
+        for name in FIELDS:
+            setattr(self, name, 0)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+
+class Accounting:
+    def __init__(self, worker=None):
+        self.worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self._usage = {}
+
+    def usage(self, tenant):
+        usage = self._usage.get(tenant)
+        if usage is None:
+            usage = self._usage[tenant] = TenantUsage()
+        return usage
+
+    def report(self):
+        '''
+        Usage by tenant with each tenant's share of total cpu and db time
+        to make noisy neighbors easy to spot.
+        '''
+        tenants = {str(t): u.to_dict() for t, u in self._usage.items()}
+        totals = {name: sum(u[name] for u in tenants.values()) for name in FIELDS}
+        for usage in tenants.values():
+            for name in ('cpu', 'db_time'):
+                usage[name + '_share'] = usage[name] / totals[name] if totals[name] else 0
+        return dict(worker=self.worker, since=self.since, now=time.time(),
+                    totals=totals, tenants=tenants)
+
+    def csv(self):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(('worker', 'since', 'now', 'tenant') + FIELDS)
+        now = time.time()
+        for tenant, usage in self._usage.items():
+            writer.writerow((self.worker, self.since, now, tenant) +
+                            tuple(getattr(usage, name) for name in FIELDS))
+        return out.getvalue()
+
+
+def count_changes(data):
+    '''
+    Number of leaf entries in a changes dict, a rough measure of
+    changeset volume.
+    '''
+    if isinstance(data, dict):
+        return sum(count_changes(v) for v in data.values())
+    if isinstance(data, (list, tuple, set)):
+        return len(data)
+    return 0
+
+
+_PLAIN = (str, bytes, int, float, bool, dict, list, tuple, set, type(None))
+
+
+class TimedDbi:
+    '''
+    Wraps a dbi, or an attribute of one such as dbi.tags, adding the time
+    spent awaiting its calls to usage.
+    '''
+
+    def __init__(self, target, usage):
+        self._target = target
+        self._usage = usage
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if callable(value):
+            return _timed_call(value, self._usage)
+        if isinstance(value, _PLAIN):
+            return value
+        return TimedDbi(value, self._usage)
+
+
+def _timed_call(fn, usage):
+    @wraps(fn)
+    def call(*args, **kwargs):
+        res = fn(*args, **kwargs)
+        if inspect.isawaitable(res):
+            return _timed_await(res, usage)
+        return res
+
+    return call
+
+
+async def _timed_await(awaitable, usage):
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        usage.db_time += time.perf_counter() - start
+        usage.db_calls += 1
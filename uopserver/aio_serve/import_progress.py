@@ -0,0 +1,81 @@
+'''
+Progress of streaming changeset imports, kept on disk.
+
+Progress is saved after every applied batch so a client can resume an
+import with the same import_id after a restart, a crash or a retry that
+lands on another worker sharing the directory; at most the batch being
+applied when a worker died is applied again.  A lock file per import
+keeps two workers from running the same import at once.  Finished
+imports are removed once older than keep seconds.  The directory is only
+created by the first import.
+'''
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+
+class ImportProgress:
+    def __init__(self, directory, keep=24 * 3600):
+        self.directory = directory
+        self.keep = keep
+
+    def path(self, tenant, import_id):
+        name = hashlib.sha1(('%s\0%s' % (tenant, import_id)).encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def new(self, import_id):
+        return dict(import_id=import_id, lines=0, changesets=0, bytes=0, done=False, error=None)
+
+    def load(self, tenant, import_id):
+        try:
+            with open(self.path(tenant, import_id) + '.json') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, tenant, progress):
+        path = self.path(tenant, progress['import_id'])
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(os.open(tmp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmp, path + '.json')
+
+    def lock(self, tenant, import_id):
+        '''
+        Returns a lock to pass to unlock, or None if the import is running.
+        '''
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        fd = os.open(self.path(tenant, import_id) + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, lock):
+        os.close(lock)
+
+    def prune(self):
+        cutoff = time.time() - self.keep
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.endswith('.json') or entry.stat().st_mtime > cutoff:
+                continue
+            try:
+                with open(entry.path) as f:
+                    done = json.load(f).get('done')
+            except (OSError, ValueError):
+                continue
+            if done:
+                base = entry.path[:-len('.json')]
+                for path in (entry.path, base + '.lock'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
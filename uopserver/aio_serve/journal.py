@@ -0,0 +1,305 @@
+'''
+Append only journal used for write-behind application of changesets.
+
+Each record is a json line holding a sequence number, the tenant and the
+changeset.  Appends are grouped and fsync'd together and only acknowledged
+once on disk.  Records are then applied in sequence order by a background
+task.  A record failing with one of the retryable errors, e.g. the
+database being unreachable, is retried with backoff and later records
+wait behind it.  Any other failure is tried a few times and then the
+record is moved to the dead letter file, path + '.dead', with its error,
+so one bad changeset can't stop write-behind for the worker.
+
+The last applied sequence number is kept next to the journal so a
+restart replays only what wasn't applied.  That marker is not fsync'd, so
+after a crash the last records may be applied a second time; should that
+fail they end up in the dead letter file too.  Once the file grows past
+compact_size it is rewritten with only the unapplied records, and at most
+max_pending records may wait to be applied before appends are refused.
+
+Sequence numbers are local to one journal, so each worker process needs
+its own journal file.  token() names the journal along with the sequence
+number so a token can be told apart from another journal's.
+'''
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JournalFull(Exception):
+    pass
+
+
+class Journal:
+    def __init__(self, path, apply, flush_interval=0.005, retry_delay=0.5, max_retry_delay=30,
+                 retryable=(OSError, asyncio.TimeoutError), attempts=3,
+                 max_pending=10000, compact_size=64 * 1024 * 1024):
+        '''
+        :param path: journal file path
+        :param apply: async fn(tenant, changes) applying one changeset dict
+        :param flush_interval: time appends are gathered before an fsync
+        :param retry_delay: first wait before retrying a failed apply
+        :param max_retry_delay: longest wait between retries
+        :param retryable: errors retried until the apply succeeds
+        :param attempts: tries for other errors before dead lettering
+        :param max_pending: unapplied records at which appends are refused
+        :param compact_size: file size past which applied records are dropped
+        '''
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retryable = retryable
+        self.attempts = attempts
+        self.max_pending = max_pending
+        self.compact_size = compact_size
+        self.id = None
+        self._apply = apply
+        self._applied_path = path + '.applied'
+        self._dead_path = path + '.dead'
+        self._seq = 0
+        self._written = 0
+        self._applied = 0
+        self._size = 0
+        self._tenant_written = {}
+        self._pending = []
+        self._file = None
+        self._tasks = []
+
+    @property
+    def applied(self):
+        return self._applied
+
+    def token(self, seq):
+        return '%s.%d' % (self.id, seq)
+
+    def token_seq(self, token):
+        '''
+        Returns the sequence number of a token from token(), None if the
+        token belongs to another journal.  Raises ValueError when token is
+        malformed.
+        '''
+        journal_id, _, seq = token.rpartition('.')
+        seq = int(seq)
+        if not journal_id:
+            raise ValueError('not a journal token: %s' % token)
+        return seq if journal_id == self.id else None
+
+    async def start(self):
+        self.id = self._read_id()
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._io_lock = asyncio.Lock()
+        self._applied_changed = asyncio.Condition()
+        self._applied = self._read_applied()
+        self._seq = self._written = self._applied
+        records, good_size = self._read_records()
+        for record in records:
+            if record['seq'] > self._applied:
+                self._queue.put_nowait(record)
+                self._seq = self._written = max(self._seq, record['seq'])
+                self._tenant_written[record['tenant']] = record['seq']
+        if not self._queue.empty():
+            logger.info('replaying %d journal records from %s', self._queue.qsize(), self.path)
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        if self._size > good_size:
+            # drop a torn final write so new records start on their own line
+            self._truncate(good_size)
+        self._tasks = [asyncio.create_task(self._flusher()),
+                       asyncio.create_task(self._applier())]
+
+    async def close(self):
+        await self._flush()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._write_applied(self._applied)
+        self._file.close()
+
+    async def append(self, tenant, changes):
+        '''
+        Durably records changes for tenant returning its sequence number.
+        Raises JournalFull when max_pending records wait to be applied.
+        '''
+        if self._seq - self._applied >= self.max_pending:
+            raise JournalFull('%d journal records not yet applied' % (self._seq - self._applied))
+        self._seq += 1
+        record = dict(seq=self._seq, tenant=tenant, changes=changes)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((record, future))
+        self._wakeup.set()
+        await future
+        return record['seq']
+
+    async def wait_applied(self, seq, timeout=None):
+        async with self._applied_changed:
+            await asyncio.wait_for(
+                self._applied_changed.wait_for(lambda: self._applied >= seq), timeout)
+
+    async def wait_tenant(self, tenant, timeout=None):
+        '''
+        Waits until all changes acknowledged for tenant so far are applied.
+        '''
+        await self.wait_applied(self._tenant_written.get(tenant, 0), timeout)
+
+    def _read_id(self):
+        id_path = self.path + '.id'
+        try:
+            with open(id_path) as f:
+                journal_id = f.read().strip()
+        except FileNotFoundError:
+            journal_id = None
+        if not journal_id:
+            journal_id = uuid.uuid4().hex[:12]
+            tmp = id_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(journal_id)
+            os.replace(tmp, id_path)
+        return journal_id
+
+    def _read_applied(self):
+        try:
+            with open(self._applied_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_applied(self, seq):
+        # close() may write while an executor thread still does
+        tmp = '%s.%d.tmp' % (self._applied_path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(str(seq))
+        os.replace(tmp, self._applied_path)
+
+    def _read_records(self):
+        '''
+        Returns the journal's records and the size of the file up to the
+        end of its last complete line.
+        '''
+        records, good_size = [], 0
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return records, good_size
+        with f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # torn final write from a crash, never acknowledged
+                    logger.warning('dropping partial journal record in %s', self.path)
+                    break
+                good_size += len(line)
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.error('skipping corrupt journal record in %s', self.path)
+        return records, good_size
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._size += len(data)
+
+    def _truncate(self, size=0):
+        self._file.truncate(size)
+        os.fsync(self._file.fileno())
+        self._size = size
+
+    def _compact(self, applied):
+        '''
+        Rewrites the journal keeping only records past applied.
+        '''
+        records, _ = self._read_records()
+        tmp = self.path + '.tmp'
+        size = 0
+        with open(tmp, 'wb') as f:
+            for record in records:
+                if record['seq'] > applied:
+                    line = json.dumps(record).encode() + b'\n'
+                    f.write(line)
+                    size += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_applied(applied)
+        os.replace(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, 'ab')
+        self._size = size
+
+    def _dead_letter(self, record, error):
+        line = json.dumps(dict(record, error=repr(error), failed=time.time()), default=str)
+        with open(self._dead_path, 'ab') as f:
+            f.write(line.encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _flusher(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        self._wakeup.clear()
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        data = b''.join(json.dumps(record).encode() + b'\n' for record, _ in pending)
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._io_lock:
+                await loop.run_in_executor(None, self._write, data)
+                self._written = pending[-1][0]['seq']
+                for record, _ in pending:
+                    self._tenant_written[record['tenant']] = record['seq']
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        for record, future in pending:
+            self._queue.put_nowait(record)
+            future.set_result(record['seq'])
+
+    async def _applier(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self._queue.get()
+            delay = self.retry_delay
+            failures = 0
+            while True:
+                try:
+                    await self._apply(record['tenant'], record['changes'])
+                    break
+                except self.retryable:
+                    logger.exception('failed applying journal record %d, retrying in %.1fs',
+                                     record['seq'], delay)
+                except Exception as e:
+                    failures += 1
+                    if failures >= self.attempts:
+                        logger.exception('giving up on journal record %d, moved to %s',
+                                         record['seq'], self._dead_path)
+                        await loop.run_in_executor(None, self._dead_letter, record, e)
+                        break
+                    logger.exception('failed applying journal record %d, retrying in %.1fs',
+                                     record['seq'], delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            async with self._applied_changed:
+                self._applied = record['seq']
+                self._applied_changed.notify_all()
+            if self._queue.empty() or record['seq'] % 100 == 0:
+                await loop.run_in_executor(None, self._write_applied, record['seq'])
+            if self._queue.empty():
+                async with self._io_lock:
+                    if self._written == self._applied:
+                        await loop.run_in_executor(None, self._truncate)
+            elif self._size > self.compact_size:
+                async with self._io_lock:
+                    await loop.run_in_executor(None, self._compact, self._applied)
@@ -3,11 +3,12 @@ from cryptography import fernet
 from aiohttp import web
 from aiohttp_session import setup, get_session, session_middleware
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from uopserver.aio_serve.views import routes, base_context
+from uopserver.aio_serve.views import routes, base_context, on_startup, on_cleanup, request_timer
 from uop import db_service
 import aiohttp_cors
 import logging
 import argparse
+import os
 
 logger = logging.getLogger()
 
@@ -31,8 +32,10 @@ async def make_app():
     fernet_key = fernet.Fernet.generate_key()
     secret_key = base64.urlsafe_b64decode(fernet_key)
     setup(app, EncryptedCookieStorage(secret_key))
+    app.middlewares.append(request_timer)
     app.add_routes(routes)
-    # app.router.add_static('/', path='/var/www/pkm/', name='static2')
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
 
     # Configure CORS on all routes.
     for route in list(app.router.routes()):
@@ -47,8 +50,30 @@ def main():
     parser.add_argument('-t', '--dbType', type=str, help='type of database', default='mongo')
     parser.add_argument('-d', '--dbName', type=str, help='name of database', default='pkm_app')
     parser.add_argument('-H', '--dbHost', type=str, help='host of database', default='localhost')
+    parser.add_argument('-j', '--journal', type=str, default=None,
+                        help='journal file enabling write-behind of posted changes, one per worker')
+    parser.add_argument('--notifyBind', type=str, default=None,
+                        help='zeromq endpoint this worker publishes change notifications on')
+    parser.add_argument('--notifyConnect', type=str, default='',
+                        help='comma separated zeromq endpoints of all workers to get change notifications from')
+    parser.add_argument('--snapshotDir', type=str, default=None,
+                        help='private directory enabling prebuilt tenant snapshots, shared by all workers')
+    parser.add_argument('-s', '--staticRoot', type=str, default='/var/www/pkm',
+                        help='directory of the frontend build served for unmatched paths')
+    parser.add_argument('--importDir', type=str,
+                        default=os.path.join(os.path.expanduser('~'), '.uopserver', 'imports'),
+                        help='directory keeping import progress for resume, shared by all workers')
+    parser.add_argument('--singleWorker', action='store_true',
+                        help='only one aioserve process serves this database, enables list ETags')
     options = parser.parse_args(sys.argv[1:])
     print('current options', options)
+    base_context['single_worker'] = options.singleWorker
+    base_context['journal_path'] = options.journal
+    base_context['notify_bind'] = options.notifyBind
+    base_context['snapshot_dir'] = options.snapshotDir
+    base_context['static_root'] = options.staticRoot
+    base_context['import_dir'] = options.importDir
+    base_context['notify_connect'] = options.notifyConnect.split(',')
     base_context['service'] = db_service.get_service(options.dbType, use_async=True, host=options.dbHost, db_name=options.dbName)
     web.run_app(app, host='0.0.0.0', access_log_format=" :: %r %s %T %t")
 
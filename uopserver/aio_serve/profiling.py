@@ -0,0 +1,185 @@
+'''
+Event loop profiling for admins.
+
+profile_loop runs cProfile on the event loop thread for a number of
+seconds.  sample_loop instead samples the loop thread's stack from a side
+thread and returns collapsed stacks as used by flamegraph tools.
+
+SlowRequests records requests whose handler held the loop longer than a
+threshold in a single step, or ran longer than it overall, along with the
+route and tenant.  Handlers are wrapped with timed() so each step between
+awaits is measured on its own.
+'''
+import asyncio
+import collections
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class TimedCoroutine:
+    '''
+    Awaitable driving coro step by step and calling on_step(wall, cpu)
+    with the time spent in each step, that is the time coro held the loop
+    between two awaits.
+    '''
+
+    def __init__(self, coro, on_step):
+        self._coro = coro
+        self._on_step = on_step
+
+    def __await__(self):
+        coro = self._coro
+        value, error = None, None
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                if error is not None:
+                    future = coro.throw(error)
+                else:
+                    future = coro.send(value)
+            except StopIteration as e:
+                self._on_step(time.perf_counter() - wall, time.thread_time() - cpu)
+                return e.value
+            except BaseException:
+                self._on_step(time.perf_counter() - wall, time.thread_time() - cpu)
+                raise
+            self._on_step(time.perf_counter() - wall, time.thread_time() - cpu)
+            value, error = None, None
+            try:
+                value = yield future
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                error = e
+
+
+def timed(coro, on_step):
+    return TimedCoroutine(coro, on_step)
+
+
+_profiling = threading.Lock()
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+async def profile_loop(seconds, raw=False):
+    '''
+    cProfiles everything run on the event loop for seconds.  Returns the
+    pstats report as text or, with raw, the marshalled stats that
+    pstats.Stats and tools like snakeviz load.
+    '''
+    if not _profiling.acquire(blocking=False):
+        raise ProfilerBusy('a profile is already running')
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        _profiling.release()
+    if raw:
+        profiler.create_stats()
+        return marshal.dumps(profiler.stats)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(100)
+    return out.getvalue()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _sample(thread_id, interval, stop, counts):
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        counts[';'.join(reversed(stack))] += 1
+
+
+async def sample_loop(seconds, interval=0.005):
+    '''
+    Samples the event loop thread's stack every interval for seconds and
+    returns collapsed stacks, one "frame;frame;... count" line per stack.
+    '''
+    if not _profiling.acquire(blocking=False):
+        raise ProfilerBusy('a profile is already running')
+    try:
+        counts = collections.Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=_sample, args=(threading.get_ident(), interval, stop, counts), daemon=True)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+    finally:
+        _profiling.release()
+    return ''.join('%s %d\n' % item for item in counts.most_common())
+
+
+class _AsyncioWarnings(logging.Handler):
+    def __init__(self, records):
+        super().__init__(logging.WARNING)
+        self._records = records
+
+    def emit(self, record):
+        self._records.append(dict(kind='callback', time=record.created, message=record.getMessage()))
+
+
+class SlowRequests:
+    '''
+    Records requests holding the event loop, and with asyncio debug mode
+    the loop's own slow callback warnings, while enabled.
+    '''
+
+    def __init__(self, max_records=1000):
+        self.enabled = False
+        self.threshold = 0.1
+        self.records = collections.deque(maxlen=max_records)
+        self._handler = _AsyncioWarnings(self.records)
+
+    def enable(self, threshold=None, loop_debug=False):
+        if threshold is not None:
+            self.threshold = threshold
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = self.threshold
+        loop.set_debug(loop_debug)
+        asyncio_logger = logging.getLogger('asyncio')
+        if loop_debug:
+            asyncio_logger.addHandler(self._handler)
+        else:
+            asyncio_logger.removeHandler(self._handler)
+        self.enabled = True
+
+    def disable(self):
+        asyncio.get_running_loop().set_debug(False)
+        logging.getLogger('asyncio').removeHandler(self._handler)
+        self.enabled = False
+
+    def record(self, route, tenant, wall, longest_step, cpu):
+        if longest_step >= self.threshold or wall >= self.threshold:
+            self.records.append(dict(
+                kind='request', time=time.time(), route=route, tenant=tenant,
+                wall=wall, longest_step=longest_step, cpu=cpu,
+                blocked_loop=longest_step >= self.threshold))
+
+    def status(self):
+        return dict(enabled=self.enabled, threshold=self.threshold, records=list(self.records))
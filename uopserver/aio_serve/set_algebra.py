@@ -0,0 +1,338 @@
+'''
+Server side boolean expressions over tagsets, groupsets and rolesets.
+
+Object ids are interned to small integers per tenant and sets are
+evaluated as python ints used as bitmaps so AND/OR/NOT are single big int
+operations regardless of set size.  A cached set is kept as a bitmap only
+when it is dense enough for that to be smaller than an array of its
+indices; a bitmap costs a bit per interned id, not per member.  The cache
+evicts least recently used sets past max_bytes and starts over with a
+fresh interning once more than max_ids ids were interned.
+
+An expression is json of the form
+
+    {"and": [expr, ...]}, {"or": [expr, ...]}, {"not": expr}
+    {"tag": tag_id}, {"group": group_id}, {"role": role_id, "object": object_id}
+
+NOT may only appear as an operand of an AND that also has at least one
+positive operand, so {"and": [a, {"not": b}]} is a minus b.  A NOT
+anywhere else would need the set of every object of the tenant and is
+rejected.
+'''
+from array import array
+from collections import OrderedDict
+import sys
+
+# a sparse member takes 32 bits, against one bit per interned id for a bitmap
+SPARSE_BITS = 32
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class Interner:
+    def __init__(self):
+        self._index = {}
+        self._ids = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def bit(self, object_id):
+        index = self._index.get(object_id)
+        if index is None:
+            index = len(self._ids)
+            self._index[object_id] = index
+            self._ids.append(object_id)
+        return 1 << index
+
+    def known_bit(self, object_id):
+        index = self._index.get(object_id)
+        return 0 if index is None else 1 << index
+
+    def bitmap(self, object_ids):
+        res = 0
+        for object_id in object_ids:
+            res |= self.bit(object_id)
+        return res
+
+    def ids(self, bitmap):
+        ids = self._ids
+        return [ids[index] for index in _indices(bitmap)]
+
+
+def _indices(bitmap):
+    index = 0
+    while bitmap:
+        low = bitmap & 0xFFFFFFFF
+        while low:
+            lowest = low & -low
+            yield index + lowest.bit_length() - 1
+            low ^= lowest
+        bitmap >>= 32
+        index += 32
+
+
+def _pack(bitmap):
+    '''
+    Cached form of bitmap, an array of its indices when that is smaller.
+    '''
+    if bin(bitmap).count('1') * SPARSE_BITS < bitmap.bit_length():
+        return array('I', _indices(bitmap))
+    return bitmap
+
+
+def _unpack(value):
+    if isinstance(value, int):
+        return value
+    if not value:
+        return 0
+    buf = bytearray(max(value) // 8 + 1)
+    for index in value:
+        buf[index >> 3] |= 1 << (index & 7)
+    return int.from_bytes(buf, 'little')
+
+
+class SetCache:
+    '''
+    Per tenant cache of sets keyed by ('tag', tag_id), ('group', group_id)
+    or ('role', object_id, role_id).  Sets are loaded lazily from the dbi
+    and kept current from applied changesets.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_ids=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_ids = max_ids
+        self.interner = Interner()
+        self._sets = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+
+    @property
+    def size(self):
+        return self._bytes
+
+    async def get(self, dbi, key):
+        value = self._sets.get(key)
+        if value is not None:
+            self._sets.move_to_end(key)
+            return _unpack(value)
+        generation = self._generation
+        bitmap = self.interner.bitmap(await self._load(dbi, key))
+        if generation == self._generation:
+            # don't keep a load that raced with applied changes
+            self._store(key, bitmap)
+        return bitmap
+
+    def compact(self):
+        '''
+        Starts over with a fresh interning once too many ids were interned.
+        Ids are never dropped from an interning as cached sets refer to
+        them by index.
+        '''
+        if len(self.interner) > self.max_ids:
+            self.clear()
+
+    def _store(self, key, bitmap):
+        self._discard(key)
+        value = self._sets[key] = _pack(bitmap)
+        self._bytes += sys.getsizeof(value)
+        while self._bytes > self.max_bytes and len(self._sets) > 1:
+            self._discard(next(iter(self._sets)))
+
+    def _discard(self, key):
+        value = self._sets.pop(key, None)
+        if value is not None:
+            self._bytes -= sys.getsizeof(value)
+
+    async def _load(self, dbi, key):
+        kind = key[0]
+        if kind == 'tag':
+            return await dbi.get_tagset(key[1])
+        if kind == 'group':
+            return await dbi.get_groupset(key[1])
+        return await dbi.get_roleset(key[1], key[2])
+
+    def clear(self):
+        self._generation += 1
+        self._sets.clear()
+        self._bytes = 0
+        self.interner = Interner()
+
+    def invalidate(self, kind, *key):
+        '''
+        Drops the cached set for (kind, *key), or all sets of kind when no
+        key is given, so they are reloaded on next use.
+        '''
+        self._generation += 1
+        if key:
+            self._discard((kind,) + key)
+        else:
+            self._drop_kind(kind)
+
+    def apply_changes(self, changes):
+        '''
+        Brings cached sets up to date with an applied changeset.  Where a
+        change can't be read precisely the affected sets are dropped and
+        reloaded on next use.
+        '''
+        self._generation += 1
+        data = changes.to_dict() if hasattr(changes, 'to_dict') else changes
+        if not isinstance(data, dict):
+            self.clear()
+            return
+        for kind, name in (('tag', 'tagged'), ('group', 'grouped')):
+            self._apply_pairs(kind, data.get(name))
+        self._apply_related(data.get('related'))
+        objects = data.get('objects')
+        deleted = objects.get('deleted') if isinstance(objects, dict) else None
+        if deleted:
+            mask = 0
+            for object_id in deleted:
+                mask |= self.interner.known_bit(object_id)
+            if mask:
+                gone = set(_indices(mask))
+                for key, value in list(self._sets.items()):
+                    if isinstance(value, int):
+                        self._replace(key, value & ~mask)
+                    elif not gone.isdisjoint(value):
+                        self._replace(key, array('I', (i for i in value if i not in gone)))
+
+    def _apply_pairs(self, kind, changes):
+        if not changes:
+            return
+        if not isinstance(changes, dict):
+            self._drop_kind(kind)
+            return
+        for op, sign in (('inserted', True), ('deleted', False)):
+            for set_id, object_ids in _pairs(changes.get(op)):
+                if set_id is None:
+                    self._drop_kind(kind)
+                    return
+                self._update((kind, set_id), object_ids, sign)
+
+    def _apply_related(self, changes):
+        if not changes:
+            return
+        if not isinstance(changes, dict):
+            self._drop_kind('role')
+            return
+        for op, sign in (('inserted', True), ('deleted', False)):
+            entries = changes.get(op) or []
+            if isinstance(entries, dict):
+                entries = entries.values()
+            for entry in entries:
+                if isinstance(entry, dict):
+                    entry = (entry.get('subject'), entry.get('role'), entry.get('object'))
+                if not isinstance(entry, (list, tuple)) or len(entry) != 3:
+                    self._drop_kind('role')
+                    return
+                subject, role, obj = entry
+                self._update(('role', subject, role), [obj], sign)
+
+    def _update(self, key, object_ids, insert):
+        value = self._sets.get(key)
+        if value is None:
+            return
+        bitmap = _unpack(value)
+        changed = self.interner.bitmap(object_ids)
+        self._replace(key, _pack(bitmap | changed if insert else bitmap & ~changed))
+
+    def _replace(self, key, value):
+        '''
+        Updates a cached set in place, keeping its recency.
+        '''
+        self._bytes += sys.getsizeof(value) - sys.getsizeof(self._sets[key])
+        self._sets[key] = value
+
+    def _drop_kind(self, kind):
+        for key in [k for k in self._sets if k[0] == kind]:
+            self._discard(key)
+
+
+def _pairs(entries):
+    '''
+    yields (set_id, object_ids) from either {set_id: [object_id, ...]} or
+    [[set_id, object_id], ...] shaped changes.  set_id is None when the
+    shape is not recognized.
+    '''
+    if not entries:
+        return
+    if isinstance(entries, dict):
+        for set_id, object_ids in entries.items():
+            if isinstance(object_ids, str):
+                object_ids = [object_ids]
+            yield set_id, object_ids
+        return
+    for entry in entries:
+        if isinstance(entry, (list, tuple)) and len(entry) == 2:
+            yield entry[0], [entry[1]]
+        else:
+            yield None, None
+
+
+def _leaf_key(expr):
+    if 'tag' in expr:
+        return 'tag', expr['tag']
+    if 'group' in expr:
+        return 'group', expr['group']
+    if 'role' in expr and 'object' in expr:
+        return 'role', expr['object'], expr['role']
+    raise ExpressionError('unknown set expression %r' % (expr,))
+
+
+def _leaves(expr, found, in_and=False):
+    if not isinstance(expr, dict) or len(expr) == 0:
+        raise ExpressionError('set expression must be an object, got %r' % (expr,))
+    if 'and' in expr or 'or' in expr:
+        is_and = 'and' in expr
+        operands = expr['and'] if is_and else expr['or']
+        if not isinstance(operands, list) or not operands:
+            raise ExpressionError('and/or need a non-empty list of operands')
+        if is_and and all(isinstance(sub, dict) and 'not' in sub for sub in operands):
+            raise ExpressionError('and needs at least one operand that is not a not')
+        for sub in operands:
+            _leaves(sub, found, is_and)
+    elif 'not' in expr:
+        if not in_and:
+            raise ExpressionError('not is only allowed as an operand of and')
+        _leaves(expr['not'], found)
+    else:
+        found.add(_leaf_key(expr))
+    return found
+
+
+def _evaluate(expr, sets):
+    if 'and' in expr:
+        positive = [sub for sub in expr['and'] if 'not' not in sub]
+        res = _evaluate(positive[0], sets)
+        for sub in positive[1:]:
+            res &= _evaluate(sub, sets)
+        for sub in expr['and']:
+            if 'not' in sub:
+                res &= ~_evaluate(sub['not'], sets)
+        return res
+    if 'or' in expr:
+        res = 0
+        for sub in expr['or']:
+            res |= _evaluate(sub, sets)
+        return res
+    return sets[_leaf_key(expr)]
+
+
+async def evaluate(cache, dbi, expr):
+    '''
+    Returns the bitmap for expr over cache.interner, loading any sets not
+    yet cached.
+    '''
+    keys = _leaves(expr, set())
+    cache.compact()
+    while True:
+        interner = cache.interner
+        sets = {}
+        for key in keys:
+            sets[key] = await cache.get(dbi, key)
+        if cache.interner is interner:
+            return _evaluate(expr, sets)
+        # the cache was cleared while loading, the bitmaps mix internings
@@ -0,0 +1,97 @@
+'''
+Server side sort, offset/limit and field projection of list results.
+
+Backends are handed the shaping options they name in their signature and
+whatever they don't take is applied here, so results come back the same
+whichever backend produced them.
+'''
+import inspect
+import json
+
+
+def supported_kwargs(fn, **kwargs):
+    '''
+    Returns the subset of kwargs that fn names as parameters.  A **kwargs
+    catch-all doesn't count, the backend may silently ignore what it gets.
+    '''
+    try:
+        params = inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return {}
+    named = {name for name, p in params.items()
+             if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)}
+    return {k: v for k, v in kwargs.items() if v is not None and k in named}
+
+
+def sort_key(field):
+    '''
+    Key ordering objects by field that works whatever values the field
+    holds: numbers before strings and anything else by its json form.
+    '''
+    def key(obj):
+        value = field_value(obj, field)
+        if isinstance(value, (int, float)):
+            return 0, value
+        if isinstance(value, str):
+            return 1, value
+        return 2, json.dumps(value, sort_keys=True, default=str)
+
+    return key
+
+
+def field_value(obj, field):
+    return obj.get(field) if isinstance(obj, dict) else None
+
+
+def sort_results(results, sort):
+    '''
+    Sorts by field, or descending by -field.  Objects missing the field
+    come last either way.
+    '''
+    field = sort.lstrip('-')
+    present, missing = [], []
+    for obj in results:
+        (missing if field_value(obj, field) is None else present).append(obj)
+    present.sort(key=sort_key(field), reverse=sort.startswith('-'))
+    return present + missing
+
+
+def shape_results(results, fields=None, sort=None, limit=None, offset=None):
+    '''
+    Applies sort, offset/limit and field projection on the server.  These
+    are idempotent so they are safe to apply to results a backend already
+    shaped.
+    '''
+    results = list(results)
+    if sort:
+        results = sort_results(results, sort)
+    if offset:
+        results = results[offset:]
+    if limit is not None:
+        results = results[:limit]
+    if fields:
+        wanted = set(fields) | {'_id'}
+        results = [{k: v for k, v in obj.items() if k in wanted} if isinstance(obj, dict) else obj
+                   for obj in results]
+    return results
+
+
+async def shaped_call(fn, *args, fields=None, sort=None, limit=None, offset=None):
+    '''
+    Calls a dbi list producer passing down whichever shaping options it
+    supports and applies the rest on the server.
+    '''
+    options = dict(fields=fields, sort=sort, limit=limit, offset=offset)
+    passed = supported_kwargs(fn, **options)
+    if sort and 'sort' not in passed:
+        # cutting before our sort would return the wrong window
+        passed.pop('limit', None)
+        passed.pop('offset', None)
+    if fields and sort and 'fields' in passed:
+        passed['fields'] = fields + [sort.lstrip('-')]
+    if 'limit' in passed and 'offset' not in passed and offset:
+        passed['limit'] = limit + offset
+    res = await fn(*args, **passed)
+    if 'offset' in passed:
+        options['offset'] = None
+    return shape_results(res, **options)
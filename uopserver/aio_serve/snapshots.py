@@ -0,0 +1,254 @@
+'''
+Prebuilt gzipped tenant snapshots for client bootstrap.
+
+A snapshot holds a tenant's metadata, objects and relationships along
+with the changes cursor taken just before it was read.  A client loads
+the snapshot and then asks /changes for everything after that cursor, so
+a snapshot that is somewhat stale is still correct to hand out.
+
+Snapshots are only kept for tenants that asked for one.  After changes
+they are rebuilt in the background, at most once per min_interval, and
+the previous file is served until the new one replaces it.  Workers
+sharing the snapshot directory share the files: a lock file lets only one
+of them rebuild a tenant's snapshot, and a small meta file next to it
+holds its cursor so the others pick up the new snapshot instead of
+building their own.  Snapshots hold all of a tenant's data so the
+directory is created private to the server's user.
+
+The first snapshot of a tenant is built in the background as well, get
+returns None until it is there.  A build streams the json into the gzip
+file as it is read, keeping only object ids in memory, and reads sets
+and relationships READ_BATCH at a time.
+'''
+import asyncio
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+READ_BATCH = 50
+
+
+class _GzipJsonWriter:
+    '''
+    Writes json text to a private gzip file, compressing and writing in
+    the executor a chunk at a time.
+    '''
+    CHUNK = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._buffer = []
+        self._buffered = 0
+        self._raw = self._gzip = None
+
+    async def open(self):
+        def _open():
+            self._raw = Snapshots._private_file(self.path)
+            self._gzip = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+
+        await asyncio.get_running_loop().run_in_executor(None, _open)
+
+    async def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.CHUNK:
+            await self.flush()
+
+    async def flush(self):
+        data = ''.join(self._buffer).encode()
+        self._buffer, self._buffered = [], 0
+        if data:
+            await asyncio.get_running_loop().run_in_executor(None, self._gzip.write, data)
+
+    async def close(self):
+        def _close():
+            if self._gzip is not None:
+                self._gzip.close()
+            if self._raw is not None:
+                self._raw.close()
+
+        await asyncio.get_running_loop().run_in_executor(None, _close)
+
+
+class Snapshots:
+    def __init__(self, directory, tenant_dbi, min_interval=60):
+        '''
+        :param directory: where snapshot files are written
+        :param tenant_dbi: async fn(tenant) returning the tenant's dbi
+        :param min_interval: least seconds between rebuilds of a tenant
+        '''
+        self.directory = directory
+        self.min_interval = min_interval
+        self._tenant_dbi = tenant_dbi
+        self._current = {}
+        self._dirty = {}
+        self._builds = {}
+        self._failed = {}
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def path(self, tenant):
+        name = hashlib.sha1(str(tenant).encode()).hexdigest()
+        return os.path.join(self.directory, '%s.snapshot' % name)
+
+    def get(self, tenant):
+        '''
+        Returns dict(path, cursor, built) for tenant's latest snapshot.
+        None if there is none yet, starting the first build unless one is
+        running, see building, or failed less than min_interval ago.
+        '''
+        current = self._read_meta(tenant)
+        if current is None:
+            if time.time() - self._failed.get(tenant, 0) >= self.min_interval:
+                self._build_task(tenant)
+            return None
+        self._current[tenant] = current
+        return current
+
+    def building(self, tenant):
+        return tenant in self._builds
+
+    def changed(self, tenant):
+        if tenant not in self._current:
+            return
+        self._dirty.setdefault(tenant, time.time())
+        if tenant not in self._builds:
+            self._build_task(tenant, delay=True)
+
+    async def close(self):
+        tasks = list(self._builds.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _build_task(self, tenant, delay=False):
+        task = self._builds.get(tenant)
+        if task is None:
+            task = self._builds[tenant] = asyncio.create_task(self._rebuild(tenant, delay))
+        return task
+
+    async def _rebuild(self, tenant, delay):
+        try:
+            if delay:
+                current = self._read_meta(tenant) or {}
+                await asyncio.sleep(max(0, current.get('built', 0) + self.min_interval - time.time()))
+            since = self._dirty.pop(tenant, 0)
+            current = self._read_meta(tenant)
+            if current and since and current['built'] >= since:
+                # another worker rebuilt it after the change
+                self._current[tenant] = current
+            elif not await self._locked_build(tenant):
+                # another worker is building, check again once it is done
+                self._dirty.setdefault(tenant, since or time.time())
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            del self._builds[tenant]
+            raise
+        except Exception:
+            logger.exception('snapshot build failed for %s', tenant)
+            self._failed[tenant] = time.time()
+        else:
+            self._failed.pop(tenant, None)
+        del self._builds[tenant]
+        if tenant in self._dirty:
+            self._build_task(tenant, delay=True)
+
+    async def _locked_build(self, tenant):
+        lock_fd = os.open(self.path(tenant) + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            await self._build(tenant)
+            return True
+        finally:
+            os.close(lock_fd)
+
+    def _read_meta(self, tenant):
+        path = self.path(tenant)
+        try:
+            with open(path + '.meta') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return dict(path=path, cursor=meta['cursor'], built=meta['built'])
+
+    async def _build(self, tenant):
+        dbi = await self._tenant_dbi(tenant)
+        cursor = time.time()
+        path = self.path(tenant)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        out = _GzipJsonWriter(tmp)
+        loop = asyncio.get_running_loop()
+        try:
+            await out.open()
+            meta = await dbi.metadata()
+            await out.write('{"cursor": %s, "metadata": %s, "objects": [' % (
+                json.dumps(cursor), json.dumps(meta._by_id)))
+            object_ids = []
+            for obj in await dbi.objects.find():
+                await out.write((', ' if object_ids else '') + json.dumps(obj))
+                object_ids.append(obj['_id'])
+            await out.write('], "tagged": ')
+            tags = [tag['_id'] for tag in await dbi.tags.find()]
+            await self._write_map(out, tags, dbi.get_tagset)
+            await out.write(', "grouped": ')
+            groups = [group['_id'] for group in await dbi.groups.find()]
+            await self._write_map(out, groups, dbi.get_groupset)
+            await out.write(', "related": ')
+            await self._write_map(out, object_ids, dbi.get_object_relationships, skip_empty=True)
+            await out.write('}')
+            await out.flush()
+        except BaseException:
+            await out.close()
+            await loop.run_in_executor(None, self._remove, tmp)
+            raise
+        await out.close()
+        await loop.run_in_executor(None, self._publish, path, tmp, cursor)
+        self._current[tenant] = self._read_meta(tenant)
+
+    @staticmethod
+    async def _write_map(out, keys, fetch, skip_empty=False):
+        '''
+        Writes {key: fetch(key)} reading READ_BATCH keys concurrently.
+        '''
+        first = True
+        await out.write('{')
+        for start in range(0, len(keys), READ_BATCH):
+            batch = keys[start:start + READ_BATCH]
+            values = await asyncio.gather(*[fetch(key) for key in batch])
+            for key, value in zip(batch, values):
+                if skip_empty and not value:
+                    continue
+                if not isinstance(value, (dict, list)):
+                    value = list(value)
+                await out.write('%s%s: %s' % ('' if first else ', ', json.dumps(str(key)),
+                                              json.dumps(value)))
+                first = False
+        await out.write('}')
+
+    @staticmethod
+    def _private_file(path):
+        return open(os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'wb')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def _publish(cls, path, tmp, cursor):
+        # the data is replaced before the meta so a reader never sees a
+        # cursor newer than the data it goes with
+        os.replace(tmp, path)
+        with cls._private_file(tmp) as f:
+            f.write(json.dumps(dict(cursor=cursor, built=time.time())).encode())
+        os.replace(tmp, path + '.meta')
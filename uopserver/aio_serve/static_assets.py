@@ -0,0 +1,166 @@
+'''
+In memory static assets for serving the single page app without nginx.
+
+All files under root are loaded at startup together with gzip and, when
+the brotli package is installed, brotli variants of compressible files.
+Each variant gets a strong ETag.  The tree is rescanned every
+reload_interval seconds and changed files are reloaded.  Paths that are
+not files are answered with index.html so client side routes work.
+'''
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                'image/svg+xml', 'application/wasm')
+
+
+class Asset:
+    def __init__(self, path, stat):
+        self.path = path
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha1(body).hexdigest()
+        self.variants = {None: (body, '"%s"' % digest)}
+        if not self.content_type.startswith(COMPRESSIBLE):
+            return
+        compressed = gzip.compress(body, compresslevel=9)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = (compressed, '"%s-gz"' % digest)
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.variants['br'] = (compressed, '"%s-br"' % digest)
+
+    def variant(self, accept_encoding):
+        '''
+        Returns (encoding, (body, etag)) of the variant to send, the
+        acceptable encoding with the highest q-value, br on ties.
+        '''
+        accepted = accepted_encodings(accept_encoding)
+        best, best_q = None, 0
+        for encoding in ('br', 'gzip'):
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if encoding in self.variants and q > best_q:
+                best, best_q = encoding, q
+        return best, self.variants[best]
+
+
+def accepted_encodings(header):
+    '''
+    Parses an Accept-Encoding header into {coding: q}.
+    '''
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class StaticAssets:
+    def __init__(self, root, index='index.html', reload_interval=2, max_size=10 * 1024 * 1024):
+        '''
+        :param root: directory of the built frontend
+        :param index: file served for paths that aren't files
+        :param reload_interval: seconds between checks for changed files
+        :param max_size: larger files are served from disk, not cached
+        '''
+        self.root = os.path.abspath(root)
+        self.index = index
+        self.reload_interval = reload_interval
+        self.max_size = max_size
+        self._assets = {}
+        self._large = {}
+        self._task = None
+
+    async def start(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._reload)
+        logger.info('loaded %d static assets from %s', len(self._assets), self.root)
+        if self.reload_interval:
+            self._task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _scan(self):
+        found = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    found[os.path.relpath(path, self.root).replace(os.sep, '/')] = os.stat(path)
+                except FileNotFoundError:
+                    pass
+        return found
+
+    def _reload(self):
+        assets, large = {}, {}
+        for name, stat in self._scan().items():
+            path = os.path.join(self.root, name)
+            if stat.st_size > self.max_size:
+                large[name] = path
+                continue
+            asset = self._assets.get(name)
+            if asset is None or asset.stamp != (stat.st_mtime_ns, stat.st_size):
+                try:
+                    asset = Asset(path, stat)
+                except OSError:
+                    logger.exception('failed loading static asset %s', path)
+                    continue
+            assets[name] = asset
+        changed = assets.keys() != self._assets.keys() or any(
+            asset is not self._assets.get(name) for name, asset in assets.items())
+        self._assets, self._large = assets, large
+        return changed
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if await loop.run_in_executor(None, self._reload):
+                    logger.info('reloaded static assets from %s', self.root)
+            except Exception:
+                logger.exception('static asset reload failed')
+
+    def response(self, request, tail):
+        name = tail.strip('/')
+        if name in self._large:
+            return web.FileResponse(self._large[name])
+        asset = self._assets.get(name) or self._assets.get(self.index)
+        if asset is None:
+            raise web.HTTPNotFound()
+        encoding, (body, etag) = asset.variant(request.headers.get('Accept-Encoding', ''))
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+        if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+            return web.Response(status=304, headers=headers)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, content_type=asset.content_type, headers=headers)
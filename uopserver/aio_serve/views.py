@@ -1,13 +1,33 @@
 from aiohttp import web
 from functools import wraps
 import asyncio
-from aiohttp_session import get_session
+import json
+import time
+import uuid
+from aiohttp_session import get_session, SESSION_KEY
 from uop import changeset
+from uopserver.aio_serve import set_algebra, profiling
+from uopserver.aio_serve.accounting import Accounting, TimedDbi, count_changes
+from uopserver.aio_serve.import_progress import ImportProgress
+from uopserver.aio_serve.journal import Journal, JournalFull
+from uopserver.aio_serve.shaping import shape_results, shaped_call
+from uopserver.aio_serve.snapshots import Snapshots
+from uopserver.aio_serve.static_assets import StaticAssets
+from uopserver.zeromq import ChangeNotifier
 
 dbi_map = {}
+set_caches = {}
+imports = {}  # running imports on this worker
+kind_versions = {}
+slow_requests = profiling.SlowRequests()
+accounting = Accounting()
 routes = web.RouteTableDef()
 
-base_context = {'service': None}
+base_context = {'service': None, 'single_worker': False, 'journal_path': None, 'journal': None,
+                'notify_bind': None, 'notify_connect': (), 'notifier': ChangeNotifier(),
+                'snapshot_dir': None, 'snapshots': None,
+                'static_root': '/var/www/pkm', 'static': None,
+                'import_dir': None, 'import_progress': None}
 tenant_service = {}
 
 thoughts = '''
@@ -41,15 +61,236 @@ async def current_tenant(request):
     return session.get('tenant_id') if session else None
 
 
-async def get_dbi(request):
+JOURNAL_WAIT = 30
+
+
+async def get_dbi(request, ordered=True):
+    '''
+    Returns the tenant's dbi, timed for the tenant's accounting.  With a
+    journal token, as returned by POST /changes, in the seq query parameter
+    this first waits for that write to be applied so the caller reads its
+    own write-behind changes.  Tokens are only known to the worker that
+    journaled them, another worker answers 409; read-your-writes across
+    workers needs requests routed to the same worker, see nginx_aiohttp.conf.
+
+    Unless ordered is False, requests other than GET also wait until the
+    tenant's journaled changes are applied so a direct write can't overtake
+    changesets acknowledged before it.
+    '''
+    tenant = await current_tenant(request)
+    journal = base_context['journal']
+    token = request.query.get('seq')
+    if journal and token:
+        try:
+            seq = journal.token_seq(token)
+        except ValueError:
+            raise web.HTTPBadRequest(reason='seq must be a journal token')
+        if seq is None:
+            raise web.HTTPConflict(reason='seq %s was journaled by another worker' % token)
+        try:
+            await held(request, journal.wait_applied(seq, timeout=JOURNAL_WAIT))
+        except asyncio.TimeoutError:
+            raise web.HTTPServiceUnavailable(reason='journal sequence %s not yet applied' % token)
+    if journal and ordered and request.method != 'GET':
+        try:
+            await held(request, journal.wait_tenant(tenant, timeout=JOURNAL_WAIT))
+        except asyncio.TimeoutError:
+            raise web.HTTPServiceUnavailable(reason='journaled changes not yet applied')
+    return TimedDbi(dbi_map[tenant], accounting.usage(tenant))
+
+
+async def held(request, awaitable):
+    '''
+    Awaits awaitable, a wait for something else to happen such as a long
+    poll, leaving the time out of the request's wall time.
+    '''
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        request['held'] = request.get('held', 0.0) + time.perf_counter() - start
+
+
+async def tenant_dbi(tenant):
+    '''
+    dbi for tenant outside of a request, e.g. in background tasks, timed
+    for the tenant's accounting like get_dbi.
+    '''
+    dbi = dbi_map.get(tenant)
+    if dbi is None:
+        dbi = dbi_map[tenant] = await base_context['service'].tenant_interface(tenant)
+    return TimedDbi(dbi, accounting.usage(tenant))
+
+
+async def journal_apply(tenant, changes):
+    dbi = await tenant_dbi(tenant)
+    service = base_context['service']
+    changes = changeset.ChangeSet(**changes)
+    await dbi.apply_changes(changes)
+    await service.update_if_app_changes(tenant, changes)
+    await changes_applied(tenant, changes)
+
+
+async def on_startup(app):
+    static = StaticAssets(base_context['static_root'])
+    await static.start()
+    base_context['static'] = static
+    if base_context['import_dir']:
+        base_context['import_progress'] = ImportProgress(base_context['import_dir'])
+    notifier = ChangeNotifier(base_context['notify_bind'], base_context['notify_connect'])
+    await notifier.start()
+    base_context['notifier'] = notifier
+    notifier.add_remote_listener(remote_tenant_mutated)
+    if base_context['snapshot_dir']:
+        base_context['snapshots'] = Snapshots(base_context['snapshot_dir'], tenant_dbi)
+    if base_context['journal_path']:
+        journal = Journal(base_context['journal_path'], journal_apply)
+        await journal.start()
+        base_context['journal'] = journal
+
+
+async def on_cleanup(app):
+    await base_context['static'].close()
+    journal = base_context['journal']
+    if journal:
+        await journal.close()
+    if base_context['snapshots']:
+        await base_context['snapshots'].close()
+    await base_context['notifier'].close()
+
+
+LIST_KINDS = ('tags', 'groups', 'roles', 'classes', 'attributes', 'queries')
+VERSION_EPOCH = uuid.uuid4().hex[:12]
+
+
+def bump_kinds(tenant, kinds=LIST_KINDS):
+    '''
+    Invalidates the list ETags of kinds for tenant.
+    '''
+    versions = kind_versions.setdefault(str(tenant), {})
+    for kind in kinds:
+        versions[kind] = versions.get(kind, 0) + 1
+
+
+def kind_etag(tenant, kind):
+    '''
+    ETag for tenant's list of kind.  It includes an epoch unique to this
+    process as versions restart at 0 with the process.  Versions are per
+    process, so they are only used with --singleWorker.
+    '''
+    version = kind_versions.get(str(tenant), {}).get(kind, 0)
+    return '"%s-%s-%d"' % (VERSION_EPOCH, kind, version)
+
+
+async def changes_applied(tenant, changes):
+    '''
+    Called after a changeset has been applied for tenant to keep server
+    side caches current.
+    '''
+    cache = set_caches.get(tenant)
+    if cache:
+        cache.apply_changes(changes)
+    data = changes.to_dict() if hasattr(changes, 'to_dict') else changes
+    usage = accounting.usage(tenant)
+    usage.changesets += 1
+    usage.changes += count_changes(data)
+    if isinstance(data, dict):
+        tenant_mutated(tenant, [k for k in LIST_KINDS if k in data and not no_changes(data[k])])
+    else:
+        tenant_mutated(tenant, LIST_KINDS)
+
+
+def tenant_mutated(tenant, kinds=()):
+    '''
+    Shared hook for every change to tenant's data, however it was made.
+    Bumps the list ETags of kinds, schedules a snapshot rebuild and wakes
+    long poll waiters on all workers.
+    '''
+    if kinds:
+        bump_kinds(tenant, kinds)
+    if base_context['snapshots']:
+        base_context['snapshots'].changed(tenant)
+    base_context['notifier'].notify(tenant)
+
+
+def remote_tenant_mutated(tenant):
+    '''
+    tenant_mutated for changes made on another worker, which don't say
+    what changed so all of the tenant's cached state is dropped.
+    '''
+    bump_kinds(tenant)
+    drop_set_cache(tenant)
+    if base_context['snapshots']:
+        base_context['snapshots'].changed(tenant)
+
+
+async def kind_changed(request, kind):
+    '''
+    Called by handlers that create, modify or delete instances of kind.
+    '''
+    tenant_mutated(await current_tenant(request), [kind])
+
+
+async def relations_changed(request, kind, *key):
+    '''
+    Called by handlers that change tagsets, groupsets or rolesets
+    directly.  kind is tag, group or role and key identifies the set, all
+    sets of kind when not given.
+    '''
     tenant = await current_tenant(request)
-    return dbi_map[tenant]
+    cache = set_caches.get(tenant)
+    if cache:
+        cache.invalidate(kind, *key)
+    tenant_mutated(tenant)
+
+
+def drop_set_cache(tenant):
+    '''
+    Forgets tenant's cached sets after changes made on another worker.
+    '''
+    for key in [k for k in set_caches if str(k) == str(tenant)]:
+        del set_caches[key]
+
+
+async def list_response(request, kind):
+    '''
+    Returns all instances of kind with an ETag, answering a matching
+    If-None-Match with 304 without going to the database.  Without
+    --singleWorker the list is returned without an ETag.
+    '''
+    dbi = await get_dbi(request)  # waits for a journal seq if given
+    if not base_context['single_worker']:
+        return web.json_response(list(await getattr(dbi, kind).find()))
+    tenant = await current_tenant(request)
+    etag = kind_etag(tenant, kind)
+    if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.json_response(list(await getattr(dbi, kind).find()), headers={'ETag': etag})
 
 
 def multi_item(seq):
     return dict(count=len(seq), results=list(seq))
 
 
+def result_options(request):
+    '''
+    Reads the fields, sort, limit and offset query parameters shared by
+    the list producing routes.  fields is comma separated, sort is a field
+    name optionally prefixed by '-' for descending order.
+    '''
+    params = request.query
+    fields = [f for f in params.get('fields', '').split(',') if f]
+    options = dict(fields=fields or None, sort=params.get('sort') or None)
+    for key in ('limit', 'offset'):
+        try:
+            options[key] = int(params[key]) if params.get(key) else None
+        except ValueError:
+            raise web.HTTPBadRequest(reason='%s must be an integer' % key)
+        if options[key] is not None and options[key] < 0:
+            raise web.HTTPBadRequest(reason='%s must not be negative' % key)
+    return options
+
+
 def authorized():
     def outer(fn):
         @wraps(fn)
@@ -70,7 +311,7 @@ def admin_only():
         @wraps(fn)
         async def inner(request):
             session = await get_session(request)
-            if session and session.get('is_admin'):
+            if session and session.get('isAdmin'):
                 return await fn(request)
             else:
                 return web.json_response({}, reason='requires admin', status=401)
@@ -80,6 +321,50 @@ def admin_only():
     return outer
 
 
+def route_name(request):
+    resource = request.match_info.route.resource
+    return resource.canonical if resource else request.path
+
+
+@web.middleware
+async def request_timer(request, handler):
+    '''
+    Times each step of the handler for the tenant's accounting and, while
+    slow request recording is on, for slow request reports.  Must be
+    installed after the session middleware so the tenant can be read from
+    the session the handler loaded.  Time the handler was held, see held,
+    is not counted as wall time.
+    '''
+    steps = dict(cpu=0.0, longest=0.0)
+
+    def on_step(wall, cpu):
+        steps['cpu'] += cpu
+        if wall > steps['longest']:
+            steps['longest'] = wall
+
+    start = time.perf_counter()
+    response = None
+    try:
+        response = await profiling.timed(handler(request), on_step)
+        return response
+    finally:
+        wall = time.perf_counter() - start - request.get('held', 0.0)
+        session = request.get(SESSION_KEY)
+        tenant = session.get('tenant_id') if session else None
+        if tenant:
+            usage = accounting.usage(tenant)
+            usage.requests += 1
+            usage.cpu += steps['cpu']
+            usage.wall += wall
+            usage.bytes_in += getattr(request.content, 'total_bytes', 0)
+            if response is None or response.status >= 400:
+                usage.errors += 1
+            else:
+                usage.bytes_out += response.content_length or 0
+        if slow_requests.enabled:
+            slow_requests.record(route_name(request), tenant, wall, steps['longest'], steps['cpu'])
+
+
 @routes.get('/login')
 async def is_logged_in(request):
     session = await get_session(request)
@@ -102,6 +387,7 @@ async def login(request):
         session['tenant_id'] = tenant['_id']
         session['isAdmin'] = bool(tenant.get('isAdmin'))
         dbi_map[tenant['_id']] = await service.tenant_interface(tenant['_id'])
+        set_caches.pop(tenant['_id'], None)
 
         return web.json_response(tenant)
 
@@ -135,6 +421,100 @@ async def get_tenants(request):
     return web.json_response(data)
 
 
+@routes.get('/admin/profile')
+@admin_only()
+async def profile_loop(request):
+    '''
+    Profiles the event loop for seconds.  mode=sample (the default) returns
+    collapsed stacks, mode=cprofile returns a pstats report or, with
+    format=raw, marshalled pstats data.
+    :param request:
+    :return:
+    '''
+    try:
+        seconds = min(float(request.query.get('seconds', 5)), 300)
+    except ValueError:
+        return web.json_response({}, reason='seconds must be a number', status=400)
+    mode = request.query.get('mode', 'sample')
+    try:
+        if mode == 'cprofile':
+            raw = request.query.get('format') == 'raw'
+            res = await profiling.profile_loop(seconds, raw=raw)
+            if raw:
+                return web.Response(body=res, content_type='application/octet-stream')
+        elif mode == 'sample':
+            res = await profiling.sample_loop(seconds)
+        else:
+            return web.json_response({}, reason='unknown mode %s' % mode, status=400)
+    except profiling.ProfilerBusy as e:
+        return web.json_response({}, reason=str(e), status=409)
+    return web.Response(text=res)
+
+
+@routes.get('/admin/slow-requests')
+@admin_only()
+async def get_slow_requests(request):
+    return web.json_response(slow_requests.status())
+
+
+@routes.post('/admin/slow-requests')
+@admin_only()
+async def set_slow_requests(request):
+    '''
+    Turns slow request recording on or off.  Takes enabled, threshold in
+    seconds and loop_debug to also turn on asyncio's own slow callback
+    reports, and clear to drop what was recorded.
+    :param request:
+    :return:
+    '''
+    data = await request.json()
+    threshold = data.get('threshold')
+    if threshold is not None:
+        try:
+            threshold = float(threshold)
+        except (TypeError, ValueError):
+            return web.json_response({}, reason='threshold must be a number', status=400)
+        if threshold < 0:
+            return web.json_response({}, reason='threshold must not be negative', status=400)
+    if data.get('clear'):
+        slow_requests.records.clear()
+    if data.get('enabled', True):
+        slow_requests.enable(threshold, bool(data.get('loop_debug')))
+    else:
+        slow_requests.disable()
+    return web.json_response(slow_requests.status())
+
+
+@routes.get('/tenants/usage')
+@admin_only()
+async def get_tenant_usage(request):
+    '''
+    Per tenant request counts, handler cpu and wall time, dbi time, bytes
+    in and out and changeset volume since the last reset.  format=csv
+    exports it for capacity planning.  Counts are for the worker that
+    answers, named in the report along with since; sum the reports of all
+    workers for the whole server.
+    :param request:
+    :return:
+    '''
+    if request.query.get('format') == 'csv':
+        return web.Response(text=accounting.csv(), content_type='text/csv')
+    return web.json_response(accounting.report())
+
+
+@routes.post('/tenants/usage/reset')
+@admin_only()
+async def reset_tenant_usage(request):
+    '''
+    Returns and resets the usage counted by the worker that answers.
+    :param request:
+    :return:
+    '''
+    report = accounting.report()
+    accounting.reset()
+    return web.json_response(report)
+
+
 @routes.delete('/tenants/{tenant_id}')
 @authorized()
 async def drop_tenant(request):
@@ -164,30 +544,242 @@ async def object_from_string(request):
     return web.json_response(res)
 
 
+LONG_POLL_MAX = 120  # keep below proxy_read_timeout in nginx_host2.conf
+
+
+def no_changes(data):
+    '''
+    True if a changes dict holds no actual changes.  Only empty containers
+    are looked at, scalar values are bookkeeping.
+    '''
+    if isinstance(data, dict):
+        return all(no_changes(v) for v in data.values())
+    if isinstance(data, (list, tuple, set)):
+        return not data
+    return True
+
+
 @routes.get('/changes/{until}')
 @authorized()
 async def changes_since(request):
+    '''
+    Returns changes since until.  With wait=N seconds and nothing changed
+    yet the request is held until the tenant has changes, on this or any
+    other worker, or the wait passes.
+    :param request:
+    :return:
+    '''
     dbi = await get_dbi(request)
+    tenant = await current_tenant(request)
     until = request.match_info['until']
+    try:
+        wait = min(float(request.query.get('wait') or 0), LONG_POLL_MAX)
+    except ValueError:
+        return web.json_response({}, reason='wait must be a number', status=400)
+    notifier = base_context['notifier']
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    version = notifier.version(tenant)
     changes = await dbi.changes_until(until)
     data = changes.to_dict()
+    while wait > 0 and no_changes(data):
+        if not await held(request, notifier.wait(tenant, version, deadline - loop.time())):
+            break
+        version = notifier.version(tenant)
+        changes = await dbi.changes_until(until)
+        data = changes.to_dict()
     return web.json_response(data)
 
 
 @routes.post('/changes')
 @authorized()
 async def apply_changes(request):
-    dbi = await get_dbi(request)
+    '''
+    Applies posted changes.  When the server runs with a journal the
+    changes are only validated and journaled here, the response carrying
+    the journal token to pass as seq on later reads.  A journal with too
+    many records waiting to be applied answers 503 with Retry-After.
+    :param request:
+    :return:
+    '''
+    dbi = await get_dbi(request, ordered=False)
     tenant = await current_tenant(request)
     service = await current_service(request)
 
-    changes = await request.json()
-    changes = changeset.ChangeSet(**changes)
+    data = await request.json()
+    changes = changeset.ChangeSet(**data)
+    journal = base_context['journal']
+    if journal:
+        try:
+            seq = await journal.append(tenant, data)
+        except JournalFull as e:
+            return web.json_response({}, reason=str(e), status=503, headers={'Retry-After': '1'})
+        return web.json_response({'seq': journal.token(seq)})
     await dbi.apply_changes(changes)
     await service.update_if_app_changes(tenant, changes)
+    await changes_applied(tenant, changes)
     return web.json_response({})
 
 
+IMPORT_CHUNK = 64 * 1024
+IMPORT_MAX_LINE = 64 * 1024 * 1024
+IMPORT_BATCH = 100
+
+
+async def ndjson_lines(content):
+    '''
+    Yields the raw lines of a chunked NDJSON body as they arrive.  Only
+    the current partial line is held in memory.
+    '''
+    buffer = bytearray()
+    async for chunk in content.iter_chunked(IMPORT_CHUNK):
+        buffer.extend(chunk)
+        start = 0
+        end = buffer.find(b'\n', start)
+        while end >= 0:
+            yield bytes(buffer[start:end])
+            start = end + 1
+            end = buffer.find(b'\n', start)
+        del buffer[:start]
+        if len(buffer) > IMPORT_MAX_LINE:
+            raise web.HTTPRequestEntityTooLarge(IMPORT_MAX_LINE, len(buffer))
+    if buffer:
+        yield bytes(buffer)
+
+
+async def apply_import_batch(dbi, service, tenant, batch, progress):
+    for line_no, changes in batch:
+        changes = changeset.ChangeSet(**changes)
+        await dbi.apply_changes(changes)
+        await service.update_if_app_changes(tenant, changes)
+        await changes_applied(tenant, changes)
+        progress['lines'] = line_no
+        progress['changesets'] += 1
+
+
+@routes.post('/import-changes')
+@authorized()
+async def import_changes(request):
+    '''
+    Applies a chunked NDJSON body, one changeset per line, in batches as it
+    is read.  The next chunk isn't read until the current batch is applied
+    so a large import runs in bounded memory.  Progress is saved on disk
+    under import_id after every batch; to resume an import, on any worker
+    and after restarts, resend the body, or the remainder of it starting
+    at line offset, with the same import_id and lines already applied are
+    skipped.
+    :param request:
+    :return:
+    '''
+    dbi = await get_dbi(request)
+    tenant = await current_tenant(request)
+    service = await current_service(request)
+    import_id = request.query.get('import_id') or uuid.uuid4().hex
+    try:
+        line_no = int(request.query.get('offset', 0))
+        batch_size = max(1, int(request.query.get('batch', IMPORT_BATCH)))
+    except ValueError:
+        return web.json_response({}, reason='offset and batch must be integers', status=400)
+    if line_no < 0:
+        return web.json_response({}, reason='offset must not be negative', status=400)
+
+    store = base_context['import_progress']
+    if store is None:
+        return web.json_response({}, reason='imports need --importDir', status=503)
+    loop = asyncio.get_running_loop()
+    try:
+        lock = await loop.run_in_executor(None, store.lock, tenant, import_id)
+    except OSError as e:
+        return web.json_response({}, reason='import directory unusable: %s' % e, status=503)
+    if lock is None:
+        return web.json_response(store.load(tenant, import_id) or {},
+                                 reason='import already running', status=409)
+    progress = await loop.run_in_executor(None, store.load, tenant, import_id)
+    progress = progress or store.new(import_id)
+    if line_no > progress['lines']:
+        store.unlock(lock)
+        # resuming past what was applied would skip lines
+        return web.json_response(progress, reason='offset is past the applied lines', status=400)
+    progress.update(done=False, error=None)
+    tenant_imports = imports.setdefault(tenant, {})
+    tenant_imports[import_id] = progress
+
+    async def save():
+        await loop.run_in_executor(None, store.save, tenant, dict(progress))
+
+    batch = []
+    try:
+        async for line in ndjson_lines(request.content):
+            line_no += 1
+            if line_no <= progress['lines']:
+                continue
+            progress['bytes'] += len(line) + 1
+            if line.strip():
+                batch.append((line_no, json.loads(line)))
+            elif not batch:
+                progress['lines'] = line_no
+            if len(batch) >= batch_size:
+                await apply_import_batch(dbi, service, tenant, batch, progress)
+                await save()
+                batch = []
+        await apply_import_batch(dbi, service, tenant, batch, progress)
+        progress['lines'] = max(line_no, progress['lines'])
+        progress['done'] = True
+    except (ValueError, TypeError) as e:
+        progress['error'] = str(e)
+        return web.json_response(progress, reason='bad changeset', status=400)
+    finally:
+        # kept for later resume even when the request was cut off
+        await save()
+        del tenant_imports[import_id]
+        if not tenant_imports:
+            del imports[tenant]
+        store.unlock(lock)
+        await loop.run_in_executor(None, store.prune)
+    return web.json_response(progress)
+
+
+@routes.get('/import-changes/{import_id}')
+@authorized()
+async def import_progress(request):
+    tenant = await current_tenant(request)
+    import_id = request.match_info['import_id']
+    progress = imports.get(tenant, {}).get(import_id)
+    store = base_context['import_progress']
+    if progress is None and store is not None:
+        progress = await asyncio.get_running_loop().run_in_executor(None, store.load, tenant, import_id)
+    if progress is None:
+        return web.json_response({}, reason='unknown import', status=404)
+    return web.json_response(progress)
+
+
+@routes.get('/snapshot')
+@authorized()
+async def get_snapshot(request):
+    '''
+    Serves a gzipped json snapshot of the tenant's metadata, objects and
+    relationships for bootstrapping a client, which then continues with
+    /changes from the X-Changes-Cursor header (also in the snapshot as
+    cursor).  While the tenant's first snapshot is being built this
+    answers 202 with Retry-After.
+    :param request:
+    :return:
+    '''
+    tenant = await current_tenant(request)
+    snapshots = base_context['snapshots']
+    if snapshots is None:
+        return web.json_response({}, reason='snapshots not enabled', status=404)
+    current = snapshots.get(tenant)
+    if current is None:
+        if snapshots.building(tenant):
+            return web.json_response({}, reason='snapshot being built', status=202,
+                                     headers={'Retry-After': '5'})
+        return web.json_response({}, reason='snapshot not available', status=503)
+    return web.FileResponse(current['path'], headers={
+        'Content-Type': 'application/gzip',
+        'X-Changes-Cursor': str(current['cursor'])})
+
+
 @routes.get('/objects/{object_id}')
 @authorized()
 async def get_object(request):
@@ -202,7 +794,9 @@ async def modify_object_groups(request):
     dbi = await get_dbi(request)
     oid = request.match_info['object_id']
     groups = await request.json()
-    await asyncio.gather([dbi.group(oid, gid) for gid in groups])
+    await asyncio.gather(*[dbi.group(oid, gid) for gid in groups])
+    for gid in groups:
+        await relations_changed(request, 'group', gid)
 
 
 @routes.post('/object-groups/{object_id}')
@@ -212,6 +806,7 @@ async def set_object_groups(request):
     oid = request.match_info['object_id']
     groups = await request.json()
     await dbi.set_object_groups(oid, groups)
+    await relations_changed(request, 'group')
 
 
 @routes.post('/object-groups/{object_id}/{group_id}')
@@ -221,6 +816,7 @@ async def group_object(request):
     oid = request.match_info['object_id']
     group_id = request.match_info['group_id']
     await dbi.group(oid, group_id)
+    await relations_changed(request, 'group', group_id)
 
 
 @routes.get('/object-groups/{object_id}')
@@ -237,7 +833,9 @@ async def modify_object_tags(request):
     dbi = await get_dbi(request)
     oid = request.match_info['object_id']
     tags = await request.json()
-    await asyncio.gather([dbi.tag(oid, gid) for gid in tags])
+    await asyncio.gather(*[dbi.tag(oid, gid) for gid in tags])
+    for tag_id in tags:
+        await relations_changed(request, 'tag', tag_id)
 
 
 @routes.post('/object-tags/{object_id}')
@@ -247,6 +845,7 @@ async def set_object_tags(request):
     oid = request.match_info['object_id']
     tags = await request.json()
     await dbi.set_object_tags(oid, tags)
+    await relations_changed(request, 'tag')
 
 
 @routes.post('/object-tags/{object_id}/{tag_id}')
@@ -256,6 +855,7 @@ async def tag_object(request):
     oid = request.match_info['object_id']
     tag_id = request.match_info['tag_id']
     await dbi.tag(oid, tag_id)
+    await relations_changed(request, 'tag', tag_id)
 
 
 @routes.get('/object-tags/{object_id}')
@@ -328,6 +928,7 @@ async def add_related_objects(request):
     role = request.match_info['role_id']
     objects = await request.json()
     await dbi.add_object_related(oid, role, objects)
+    await relations_changed(request, 'role', oid, role)
 
 
 @routes.post('/related-objects/{object_id}/{role_id}')
@@ -344,15 +945,28 @@ async def set_related_objects(request):
     role = request.match_info['role_id']
     objects = await request.json()
     await dbi.set_object_related(oid, role, objects)
+    await relations_changed(request, 'role', oid, role)
 
 
 @routes.get('/tagged/{tag_id}')
 @authorized()
 async def get_tagged(request):
+    '''
+    Returns the ids of objects with the given tag or, when fields is
+    given, the projected objects themselves.
+    '''
     dbi = await get_dbi(request)
     tag_id = request.match_info['tag_id']
+    options = result_options(request)
     res = list(await dbi.get_tagset(tag_id))
-    return web.json_response(res)
+    if not options['fields']:
+        options['sort'] = None
+        return web.json_response(shape_results(res, **options))
+    if not options['sort']:
+        # only load the window of ids actually returned
+        res = shape_results(res, limit=options['limit'], offset=options['offset'])
+        options['limit'] = options['offset'] = None
+    return web.json_response(await shaped_call(dbi.bulk_load, res, **options))
 
 
 @routes.put('/tagged/{tag_id}')
@@ -362,6 +976,7 @@ async def add_tagged(request):
     tag_id = request.match_info['tag_id']
     objects = await request.json()
     await dbi.add_tag_objects(tag_id, object_ids=objects)
+    await relations_changed(request, 'tag', tag_id)
 
 
 @routes.post('/tagged/{tag_id}')
@@ -371,6 +986,7 @@ async def set_tagged(request):
     tag_id = request.match_info['tag_id']
     objects = await request.json()
     await dbi.set_tag_objects(tag_id, object_ids=objects)
+    await relations_changed(request, 'tag', tag_id)
 
 
 @routes.get('/groupged/{group_id}')
@@ -388,6 +1004,7 @@ async def add_groupged(request):
     group_id = request.match_info['group_id']
     objects = await request.json()
     await dbi.add_group_objects(group_id, object_ids=objects)
+    await relations_changed(request, 'group', group_id)
 
 
 @routes.post('/groupged/{group_id}')
@@ -397,13 +1014,40 @@ async def set_groupged(request):
     group_id = request.match_info['group_id']
     objects = await request.json()
     await dbi.set_group_objects(group_id, object_ids=objects)
+    await relations_changed(request, 'group', group_id)
+
+
+@routes.post('/set-query')
+@authorized()
+async def set_query(request):
+    '''
+    Evaluates a boolean expression over tagsets, groupsets and rolesets
+    on the server, see set_algebra for the expression format.  With
+    count_only set only the size of the result is returned.
+    :param request:
+    :return:
+    '''
+    dbi = await get_dbi(request)
+    tenant = await current_tenant(request)
+    expr = await request.json()
+    cache = set_caches.get(tenant)
+    if cache is None:
+        cache = set_caches[tenant] = set_algebra.SetCache()
+    try:
+        bitmap = await set_algebra.evaluate(cache, dbi, expr)
+    except set_algebra.ExpressionError as e:
+        return web.json_response({}, reason=str(e), status=400)
+    if request.query.get('count_only'):
+        return web.json_response(dict(count=bin(bitmap).count('1')))
+    options = result_options(request)
+    options['sort'] = options['fields'] = None
+    return web.json_response(multi_item(shape_results(cache.interner.ids(bitmap), **options)))
 
 
 @routes.get('/tags')
 @authorized()
 async def get_tags(request):
-    dbi = await get_dbi(request)
-    return web.json_response(list(await dbi.tags.find()))
+    return await list_response(request, 'tags')
 
 
 @routes.post('/tags')
@@ -411,7 +1055,9 @@ async def get_tags(request):
 async def create_tag(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    dbi.add_tag(**data)
+    res = await dbi.add_tag(**data)
+    await kind_changed(request, 'tags')
+    return web.json_response(res)
 
 
 @routes.put('/tags/{tag_id}')
@@ -421,7 +1067,9 @@ async def modify_tag(request):
     tag_id = request.match_info['tag_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_tag(tag_id, **data)
+    res = await dbi.modify_tag(tag_id, **data)
+    await kind_changed(request, 'tags')
+    return web.json_response(res)
 
 
 @routes.delete('/tags/{tag_id}')
@@ -430,13 +1078,15 @@ async def modify_tag(request):
     dbi = await get_dbi(request)
     tag_id = request.match_info['tag_id']
     await dbi.delete_tag(tag_id)
+    await kind_changed(request, 'tags')
+    await relations_changed(request, 'tag', tag_id)
+    return web.json_response({})
 
 
 @routes.get('/attributes')
 @authorized()
 async def get_attributes(request):
-    dbi = await get_dbi(request)
-    return web.json_response(list(await dbi.attributes.find()))
+    return await list_response(request, 'attributes')
 
 
 @routes.post('/attributes')
@@ -444,7 +1094,9 @@ async def get_attributes(request):
 async def create_attribute(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    await dbi.add_attribute(**data)
+    res = await dbi.add_attribute(**data)
+    await kind_changed(request, 'attributes')
+    return web.json_response(res)
 
 
 @routes.post('/bulk-load')
@@ -452,7 +1104,7 @@ async def create_attribute(request):
 async def bulk_load(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    res = await dbi.bulk_load(data['ids'])
+    res = await shaped_call(dbi.bulk_load, data['ids'], **result_options(request))
     return web.json_response(multi_item(res))
 
 
@@ -463,7 +1115,9 @@ async def modify_attribute(request):
     attribute_id = request.match_info['attribute_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_attribute(attribute_id, **data)
+    res = await dbi.modify_attribute(attribute_id, **data)
+    await kind_changed(request, 'attributes')
+    return web.json_response(res)
 
 
 @routes.delete('/attributes/{attribute_id}')
@@ -472,13 +1126,14 @@ async def delete_attribute(request):
     dbi = await get_dbi(request)
     attribute_id = request.match_info['attribute_id']
     await dbi.delete_attribute(attribute_id)
+    await kind_changed(request, 'attributes')
+    return web.json_response({})
 
 
 @routes.get('/groups')
 @authorized()
 async def get_groups(request):
-    dbi = await get_dbi(request)
-    return web.json_response(list(await dbi.groups.find()))
+    return await list_response(request, 'groups')
 
 
 @routes.post('/groups')
@@ -486,7 +1141,9 @@ async def get_groups(request):
 async def create_group(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    dbi.add_group(**data)
+    res = await dbi.add_group(**data)
+    await kind_changed(request, 'groups')
+    return web.json_response(res)
 
 
 @routes.put('/groups/{group_id}')
@@ -496,7 +1153,9 @@ async def modify_group(request):
     group_id = request.match_info['group_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_group(group_id, **data)
+    res = await dbi.modify_group(group_id, **data)
+    await kind_changed(request, 'groups')
+    return web.json_response(res)
 
 
 @routes.delete('/groups/{group_id}')
@@ -505,13 +1164,15 @@ async def delete_group(request):
     dbi = await get_dbi(request)
     group_id = request.match_info['group_id']
     await dbi.delete_group(group_id)
+    await kind_changed(request, 'groups')
+    await relations_changed(request, 'group', group_id)
+    return web.json_response({})
 
 
 @routes.get('/roles')
 @authorized()
 async def get_roles(request):
-    dbi = await get_dbi(request)
-    return web.json_response(list(await dbi.roles.find()))
+    return await list_response(request, 'roles')
 
 
 @routes.post('/roles')
@@ -519,7 +1180,9 @@ async def get_roles(request):
 async def create_role(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    dbi.add_role(**data)
+    res = await dbi.add_role(**data)
+    await kind_changed(request, 'roles')
+    return web.json_response(res)
 
 
 @routes.put('/roles/{role_id}')
@@ -529,7 +1192,9 @@ async def modify_role(request):
     role_id = request.match_info['role_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_role(role_id, **data)
+    res = await dbi.modify_role(role_id, **data)
+    await kind_changed(request, 'roles')
+    return web.json_response(res)
 
 
 @routes.delete('/roles/{role_id}')
@@ -538,13 +1203,16 @@ async def delete_role(request):
     dbi = await get_dbi(request)
     role_id = request.match_info['role_id']
     await dbi.delete_role(role_id)
+    await kind_changed(request, 'roles')
+    # rolesets are keyed by object and role, drop them all
+    await relations_changed(request, 'role')
+    return web.json_response({})
 
 
 @routes.get('/classes')
 @authorized()
 async def get_classes(request):
-    dbi = await get_dbi(request)
-    return web.json_response(await dbi.classes.find())
+    return await list_response(request, 'classes')
 
 
 @routes.post('/classes')
@@ -552,7 +1220,9 @@ async def get_classes(request):
 async def create_class(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    dbi.add_class(**data)
+    res = await dbi.add_class(**data)
+    await kind_changed(request, 'classes')
+    return web.json_response(res)
 
 
 @routes.put('/classes/{class_id}')
@@ -562,7 +1232,9 @@ async def modify_class(request):
     class_id = request.match_info['class_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_class(class_id, **data)
+    res = await dbi.modify_class(class_id, **data)
+    await kind_changed(request, 'classes')
+    return web.json_response(res)
 
 
 @routes.delete('/classes/{class_id}')
@@ -571,13 +1243,14 @@ async def delete_class(request):
     dbi = await get_dbi(request)
     class_id = request.match_info['class_id']
     await dbi.delete_class(class_id)
+    await kind_changed(request, 'classes')
+    return web.json_response({})
 
 
 @routes.get('/queries')
 @authorized()
 async def get_queries(request):
-    dbi = await get_dbi(request)
-    return web.json_response(list(await dbi.queries.find()))
+    return await list_response(request, 'queries')
 
 
 @routes.post('/queries')
@@ -585,7 +1258,9 @@ async def get_queries(request):
 async def create_query(request):
     dbi = await get_dbi(request)
     data = await request.json()
-    dbi.add_query(**data)
+    res = await dbi.add_query(**data)
+    await kind_changed(request, 'queries')
+    return web.json_response(res)
 
 
 @routes.put('/queries/{query_id}')
@@ -595,7 +1270,9 @@ async def modify_query(request):
     query_id = request.match_info['query_id']
     data = await request.json()
     data.pop('_id', None)  # avoid possible change of this
-    return await dbi.modify_query(query_id, **data)
+    res = await dbi.modify_query(query_id, **data)
+    await kind_changed(request, 'queries')
+    return web.json_response(res)
 
 
 @routes.delete('/queries/{query_id}')
@@ -604,6 +1281,8 @@ async def delete_query(request):
     dbi = await get_dbi(request)
     query_id = request.match_info['query_id']
     await dbi.delete_query(query_id)
+    await kind_changed(request, 'queries')
+    return web.json_response({})
 
 
 @routes.post('/run-query/{query_id}')
@@ -618,10 +1297,10 @@ async def run_query(request):
     else:
         query = await request.json()
 
-    result = await dbi.query(query)
+    result = await shaped_call(dbi.query, query, **result_options(request))
     return web.json_response(multi_item(result))
 
 
 @routes.get('/{tail:.*}')
 async def index_default(request):
-    return web.FileResponse('/var/www/pkm/index.html')
+    return base_context['static'].response(request, request.match_info['tail'])
@@ -0,0 +1,120 @@
+'''
+Change notification for long polling, shared between aioserve workers.
+
+Every worker keeps a per tenant change counter that long poll requests
+wait on.  When workers are given ZeroMQ endpoints each one publishes the
+tenants it applied changes for on its own PUB socket and subscribes to
+the PUB sockets of all workers, so a change made through any worker
+wakes waiters on every worker.  ipc:// endpoints keep this on local unix
+sockets.  Without pyzmq installed notification stays within the worker.
+'''
+import asyncio
+import logging
+import uuid
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeNotifier:
+    def __init__(self, bind=None, connect=()):
+        '''
+        :param bind: endpoint this worker publishes on, e.g. ipc:///tmp/uop-1
+        :param connect: endpoints of all workers, may include bind
+        '''
+        self.bind = bind
+        self.connect = [c for c in connect if c]
+        self._origin = uuid.uuid4().hex.encode()
+        self._versions = {}
+        self._events = {}
+        self._remote_listeners = []
+        self._pub = self._sub = self._task = None
+
+    def version(self, tenant):
+        return self._versions.get(str(tenant), 0)
+
+    def add_remote_listener(self, fn):
+        '''
+        fn(tenant) is called for changes notified by other workers.
+        '''
+        self._remote_listeners.append(fn)
+
+    async def start(self):
+        if not (self.bind or self.connect):
+            return
+        if zmq is None:
+            logger.warning('pyzmq not installed, change notification is local to this worker')
+            return
+        context = zmq.asyncio.Context.instance()
+        if self.bind:
+            self._pub = context.socket(zmq.PUB)
+            self._pub.bind(self.bind)
+        if self.connect:
+            self._sub = context.socket(zmq.SUB)
+            self._sub.setsockopt(zmq.SUBSCRIBE, b'')
+            for endpoint in self.connect:
+                self._sub.connect(endpoint)
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for socket in (self._pub, self._sub):
+            if socket is not None:
+                socket.close(linger=0)
+
+    def notify(self, tenant):
+        '''
+        Records a change for tenant and tells the other workers about it.
+        '''
+        tenant = str(tenant)
+        self._changed(tenant)
+        if self._pub is not None:
+            try:
+                self._pub.send_multipart([tenant.encode(), self._origin], flags=zmq.NOBLOCK)
+            except zmq.ZMQError:
+                logger.exception('failed publishing change for %s', tenant)
+
+    async def wait(self, tenant, version, timeout):
+        '''
+        Waits until tenant's change counter moves past version.  Returns
+        False if timeout passed first.
+        '''
+        tenant = str(tenant)
+        if self.version(tenant) != version:
+            return True
+        event = self._events.get(tenant)
+        if event is None:
+            event = self._events[tenant] = asyncio.Event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _changed(self, tenant):
+        self._versions[tenant] = self._versions.get(tenant, 0) + 1
+        event = self._events.pop(tenant, None)
+        if event:
+            event.set()
+
+    async def _listen(self):
+        while True:
+            try:
+                tenant, origin = await self._sub.recv_multipart()
+            except zmq.ZMQError:
+                logger.exception('change notification receive failed')
+                await asyncio.sleep(1)
+                continue
+            if origin == self._origin:
+                continue
+            tenant = tenant.decode()
+            self._changed(tenant)
+            for fn in self._remote_listeners:
+                fn(tenant)